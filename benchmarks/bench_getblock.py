@@ -0,0 +1,40 @@
+'''
+Block fetch latency, and tip checks.
+
+    python -m benchmarks.bench_getblock
+'''
+from benchmarks.synthetic import build_chain
+from time import perf_counter
+import tempfile
+import os
+
+BLOCKS = 200
+TRANSACTIONS_PER_BLOCK = 50
+TIP_CHECKS = 10000
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        bc = build_chain(os.path.join(tmp, 'bench.db'), BLOCKS, TRANSACTIONS_PER_BLOCK)
+
+        start = perf_counter()
+        for height in range(1, BLOCKS):
+            bc.getBlock(height)
+        elapsed = perf_counter() - start
+
+        print(f'getBlock ({TRANSACTIONS_PER_BLOCK} transactions): {1000*elapsed/(BLOCKS-1):.2f} ms/block')
+
+        start = perf_counter()
+        bc.getBlocks(1, BLOCKS)
+        elapsed = perf_counter() - start
+
+        print(f'getBlocks ({TRANSACTIONS_PER_BLOCK} transactions): {1000*elapsed/(BLOCKS-1):.2f} ms/block')
+
+        start = perf_counter()
+        for _ in range(TIP_CHECKS):
+            bc.lastBlock()
+        elapsed = perf_counter() - start
+
+        print(f'lastBlock: {1e6*elapsed/TIP_CHECKS:.2f} us/call')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+'''
+Header hashes per second on one core: Block.hash against the mining
+HeaderHasher.
+
+    python -m benchmarks.bench_mining
+'''
+from blockchain import Block
+from blockchain.mining import HeaderHasher
+from time import perf_counter, time
+
+HASHES = 500000
+
+def main():
+    b = Block('ab'*32)
+    b.transactionsRoot = 'cd'*32
+    b.timestamp = int(time())
+
+    start = perf_counter()
+    for nonce in range(HASHES):
+        b.nonce = nonce
+        b.hash()
+    print(f'Block.hash:   {HASHES/(perf_counter() - start):,.0f} H/s')
+
+    hasher = HeaderHasher(b.transactionsRoot, b.prevHash)
+    start = perf_counter()
+    for nonce in range(HASHES):
+        hasher.hash(b.timestamp, nonce)
+    print(f'HeaderHasher: {HASHES/(perf_counter() - start):,.0f} H/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+'''
+BlockChain startup time on synthetic chains: without a checkpoint, from the
+checkpoint, and with fullVerify.
+
+    python -m benchmarks.bench_startup
+'''
+from blockchain import BlockChain
+from benchmarks.synthetic import make_blocks, write_chain
+from time import perf_counter
+import tempfile
+import os
+
+def timed_open(filename, **kwargs):
+    start = perf_counter()
+    BlockChain(filename, **kwargs).close()
+    return perf_counter() - start
+
+def main():
+    for n in [10000, 100000]:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'bench.db')
+            write_chain(filename, make_blocks(n))
+
+            print(f'{n} blocks')
+            print(f'  first open (no checkpoint): {timed_open(filename):.3f} s')
+            print(f'  reopen (checkpoint):        {timed_open(filename):.3f} s')
+            print(f'  reopen (fullVerify):        {timed_open(filename, fullVerify=True):.3f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Initial sync ingestion: blocks of valid, signed transactions connected with
+insertNewBlocks in batches (as download_blocks does), with the default SQLite
+settings and with the pragmas of nodeconfig.json. A 1024 bit key keeps the
+chain quick to build, verification is still part of the measure.
+
+    python -m benchmarks.bench_sync
+'''
+from blockchain import Address, Block, BlockChain, Transaction, reward
+from cryptography.hazmat.primitives.asymmetric import rsa
+from collections import deque
+from json import loads
+from time import time, perf_counter
+import tempfile
+import os
+
+BLOCKS = 200
+TRANSACTIONS_PER_BLOCK = 20
+BATCH = 50
+
+def make_chain(a):
+    '''Genesis and BLOCKS-1 blocks: coinbase to a, then a pays itself'''
+    start = int(time()) - 600*(BLOCKS+1)
+    blocks = [Block()]
+    blocks[0].timestamp = start
+    utxos = deque() # (hash, amount) spendable by the next block
+    for height in range(1, BLOCKS):
+        b = Block(blocks[-1].hash())
+        b.timestamp = start + 600*height
+        coinbase = Transaction([], [{'address': a.address, 'amount': reward(height)}])
+        b.addTransaction(coinbase)
+        created = [coinbase.outputs_to_tuples()[0]]
+
+        if height == 2: # first coinbase split, to spend TRANSACTIONS_PER_BLOCK outputs per block
+            h, amount = utxos.popleft()
+            outputs = [{'address': a.address, 'amount': i+1} for i in range(2*TRANSACTIONS_PER_BLOCK)]
+            outputs.append({'address': a.address, 'amount': amount - sum(o['amount'] for o in outputs)})
+            t = Transaction([h], outputs)
+            t.signature = a.sign(t.hash())
+            b.addTransaction(t)
+            created += t.outputs_to_tuples()
+        elif height > 2:
+            for _ in range(min(TRANSACTIONS_PER_BLOCK, len(utxos))):
+                h, amount = utxos.popleft()
+                t = Transaction([h], [{'address': a.address, 'amount': amount}])
+                t.signature = a.sign(t.hash())
+                b.addTransaction(t)
+                created += t.outputs_to_tuples()
+
+        utxos.extend((o[0], o[3]) for o in created)
+        blocks.append(b)
+    return blocks
+
+def ingest(blocks, pragmas):
+    with tempfile.TemporaryDirectory() as tmp:
+        bc = BlockChain(os.path.join(tmp, 'bench.db'), genesisBlock=blocks[0], pragmas=pragmas)
+        start = perf_counter()
+        for i in range(1, len(blocks), BATCH):
+            bc.insertNewBlocks(blocks[i:i+BATCH])
+        elapsed = perf_counter() - start
+        bc.close()
+    return elapsed
+
+def main():
+    a = Address(priv_key=rsa.generate_private_key(public_exponent=65537, key_size=1024))
+    blocks = make_chain(a)
+    transactions = sum(len(b.transactions) for b in blocks)
+    with open('nodeconfig.json') as f:
+        pragmas = loads(f.read()).get('sqlite_pragmas')
+
+    for name, p in [('default', None), ('nodeconfig.json', pragmas)]:
+        elapsed = ingest(blocks, p)
+        print(f'{name:>16}: {(len(blocks)-1)/elapsed:.0f} blocks/s, {transactions/elapsed:.0f} tx/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+'''
+Size and encoding speed of a BLOCKS response, JSON vs the binary wire format.
+
+    python -m benchmarks.bench_wire
+'''
+from benchmarks.synthetic import make_blocks
+from blockchain import Address, wire
+from json import dumps, loads
+from uuid import uuid4
+from time import perf_counter
+
+BLOCKS = 50
+TRANSACTIONS_PER_BLOCK = 50
+ROUNDS = 5
+
+def timed(f, value):
+    start = perf_counter()
+    for _ in range(ROUNDS):
+        result = f(value)
+    return result, (perf_counter() - start)/ROUNDS
+
+def main():
+    pem = Address().sign('')[0] # real 4096 bit key, fake signatures
+    blocks = make_blocks(BLOCKS, TRANSACTIONS_PER_BLOCK)
+    for b in blocks:
+        for t in b.transactions[1:]:
+            t.signature = [pem, t.signature[1]]
+    message = {'code': 'BLOCKS', 'data': {'blocks': [b.to_dict() for b in blocks]}, 'id': str(uuid4()), 'response_to': str(uuid4())}
+
+    for name, encode, decode in [
+        ('json', lambda m: dumps(m).encode(), lambda p: loads(p.decode())),
+        ('binary', wire.dumps, wire.loads),
+    ]:
+        packet, encoding = timed(encode, message)
+        _, decoding = timed(decode, packet)
+        mb = len(packet)/1e6
+        print(f'{name:>6}: {mb:.2f} MB ({len(packet)/(BLOCKS*TRANSACTIONS_PER_BLOCK):.0f} bytes/transaction), '
+              f'encode {mb/encoding:.1f} MB/s, decode {mb/decoding:.1f} MB/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+'''
+Synthetic chains for the benchmarks.
+
+Blocks are spaced 600 seconds apart, which makes their difficulty 0, so no
+mining is needed. Rows are written straight into the database: transactions
+carry fake signatures and are not meant to pass validation, only to give
+the chain a realistic shape.
+'''
+from blockchain import Block, Transaction, BlockChain, reward
+from blockchain.SQL_setup import SETUP
+from time import time
+import sqlite3
+
+def make_transaction(i, inputs=None):
+    t = Transaction(
+        inputs if inputs is not None else [f'{i:064x}'],
+        [{'address': f'{i % 97:064x}', 'amount': 1000 + i}]
+    )
+    t.signature = ['-----BEGIN PUBLIC KEY-----', 'ff'*512]
+    return t
+
+def make_blocks(n_blocks, transactions_per_block=0, start=None):
+    start = start if start is not None else int(time()) - 600*(n_blocks+1)
+    blocks = [Block()]
+    blocks[0].timestamp = start
+    i = 0
+    for height in range(1, n_blocks):
+        b = Block(blocks[-1].hash())
+        b.timestamp = start + 600*height
+        b.addTransaction(Transaction([], [{'address': f'{height:064x}', 'amount': reward(height)}]))
+        for _ in range(transactions_per_block):
+            b.addTransaction(make_transaction(i))
+            i += 1
+        blocks.append(b)
+    return blocks
+
+def write_chain(filename, blocks):
+    con = sqlite3.connect(filename)
+    con.executescript(SETUP)
+    for b in blocks:
+        con.execute('INSERT INTO Block (transactions_root, timestamp, nonce, prevhash, hash) VALUES (?, ?, ?, ?, ?)', b.to_tuple())
+        for t in b.transactions:
+            con.execute('INSERT INTO TInBlock VALUES (?, ?)', (t.hash(), b.hash()))
+            con.execute('INSERT INTO TTransaction VALUES (?, ?, ?, ?)', t.to_tuple())
+            con.executemany('INSERT INTO TInput VALUES (?, ?)', t.inputs_to_tuples())
+            con.executemany('INSERT INTO TOutput VALUES (?, ?, ?, ?)', t.outputs_to_tuples())
+    con.commit()
+    con.close()
+
+def build_chain(filename, n_blocks, transactions_per_block=0):
+    write_chain(filename, make_blocks(n_blocks, transactions_per_block))
+    return BlockChain(filename)
@@ -29,10 +29,77 @@ CREATE TABLE IF NOT EXISTS TInBlock (
     block_hash TEXT
 );
 
+CREATE TABLE IF NOT EXISTS SchemaVersion (
+    version INTEGER
+);
+
 CREATE TABLE IF NOT EXISTS Block (
     transactions_root TEXT,
     timestamp INTEGER, 
     nonce INTEGER,
     prevhash TEXT,
     hash TEXT PRIMARY KEY
-);"""
\ No newline at end of file
+);"""
+
+'''
+Schema upgrades, applied in order by BlockChain.migrate. Each migration is a
+list of statements run in a single transaction (SQL, or functions called
+with the BlockChain for data SQL can not compute); the number of applied
+migrations is stored in SchemaVersion. Append new migrations, never edit
+the applied ones.
+'''
+MIGRATIONS = [
+    # 1: unspent outputs, maintained when blocks connect and disconnect
+    [
+        """CREATE TABLE IF NOT EXISTS UTXO (
+            hash TEXT PRIMARY KEY,
+            tx_hash TEXT,
+            address TEXT,
+            amount INTEGER
+        )""",
+        """INSERT OR IGNORE INTO UTXO
+            SELECT * FROM TOutput WHERE NOT EXISTS (SELECT * FROM TInput WHERE TInput.utxo_hash = TOutput.hash)
+        """
+    ],
+    # 2: secondary indexes
+    [
+        'CREATE INDEX IF NOT EXISTS TInput_utxo_hash ON TInput (utxo_hash)',
+        'CREATE INDEX IF NOT EXISTS TInput_tx_hash ON TInput (tx_hash)',
+        'CREATE INDEX IF NOT EXISTS TOutput_tx_hash ON TOutput (tx_hash)',
+        'CREATE INDEX IF NOT EXISTS TOutput_address ON TOutput (address)',
+        'CREATE INDEX IF NOT EXISTS TInBlock_block_hash ON TInBlock (block_hash)',
+        'CREATE INDEX IF NOT EXISTS UTXO_tx_hash ON UTXO (tx_hash)'
+    ],
+    # 3: last verified block, BlockChain.verify starts from it
+    [
+        """CREATE TABLE IF NOT EXISTS Checkpoint (
+            height INTEGER,
+            hash TEXT
+        )"""
+    ],
+    # 4: unspent outputs by address (wallet balances)
+    [
+        'CREATE INDEX IF NOT EXISTS UTXO_address ON UTXO (address)'
+    ],
+    # 5: undo records, the outputs spent by each block (restored when it is disconnected)
+    [
+        """CREATE TABLE IF NOT EXISTS Undo (
+            block_hash TEXT,
+            hash TEXT,
+            tx_hash TEXT,
+            address TEXT,
+            amount INTEGER
+        )""",
+        'CREATE INDEX IF NOT EXISTS Undo_block_hash ON Undo (block_hash)',
+        """INSERT INTO Undo SELECT TInBlock.block_hash, TOutput.* FROM TInput
+            JOIN TInBlock ON TInBlock.transaction_hash = TInput.tx_hash
+            JOIN TOutput ON TOutput.hash = TInput.utxo_hash
+        """
+    ],
+    # 6: cumulative work of the chain up to each block. Decimal TEXT: it
+    # outgrows SQLite's 64 bit integers
+    [
+        'ALTER TABLE Block ADD COLUMN work TEXT',
+        lambda chain: chain.backfill_work()
+    ]
+]
@@ -3,12 +3,18 @@ from time import time
 from hashlib import sha256
 from json import loads, dumps
 from math import floor, inf
+from bisect import bisect_left, bisect_right
 import sqlite3
+import threading
+import weakref
 
-from blockchain.SQL_setup import SETUP
+from blockchain.SQL_setup import SETUP, MIGRATIONS
+from blockchain.cache import LRUCache
 
 # TRANSACTION AMOUNT IN MICRO (1 coin = 1 000 000)
 class Transaction:
+    HASHED = ('inputs', 'outputs', 'timestamp')
+
     def __init__(
             self, 
             inputs: list[str],  
@@ -21,43 +27,56 @@ class Transaction:
         self.timestamp = time()
         self.signature = [None, None] # [pub_key, signature]
 
+    def __setattr__(self, name, value):
+        # assigning a hashed field drops the cached hash. Lists mutated in
+        # place are not detected, the load_* methods reset it themselves.
+        if name in self.HASHED:
+            object.__setattr__(self, '_hash', None)
+        object.__setattr__(self, name, value)
+
     def hash(self):
-        return sha256(str(
-            [
-                self.inputs,
-                self.outputs,
-                self.timestamp
-            ]
-        ).encode()).hexdigest()
+        if self._hash is None:
+            self._hash = sha256(str(
+                [
+                    self.inputs,
+                    self.outputs,
+                    self.timestamp
+                ]
+            ).encode()).hexdigest()
+        return self._hash
 
     def verify(self):
-        if self.signature == [None, None]:
-            return False
-        return crypto.verify(
-            self.signature[1], 
-            self.hash().encode(), 
-            crypto.public_deserialized(
-                self.signature[0]
-            )
-        )
+        return verify_many([self])[0]
+
+    def verification_key(self):
+        # what the result of verify() depends on
+        return sha256(str(
+            [self.hash(), self.signature[0], self.signature[1]]
+        ).encode()).hexdigest()
     
     def to_dict(self):
-        return self.__dict__
+        return {
+            'inputs': self.inputs,
+            'outputs': self.outputs,
+            'timestamp': self.timestamp,
+            'signature': self.signature
+        }
     
     @staticmethod
     def from_dict(dct):
         t = Transaction([], [])
-        t.__dict__ = dct
+        t.inputs = dct['inputs']
+        t.outputs = dct['outputs']
+        t.timestamp = dct['timestamp']
+        t.signature = dct['signature']
         return t
 
     def to_json(self):
-        return dumps(self.__dict__)
+        return dumps(self.to_dict())
 
     @classmethod
     def from_json(self, json):
-        new = Transaction([], [])
-        new.__dict__ = loads(json)
-        return new
+        return Transaction.from_dict(loads(json))
     
     def to_tuple(self):
         return (self.timestamp, self.signature[0], self.signature[1], self.hash())
@@ -72,6 +91,7 @@ class Transaction:
     def load_inputs_from_tuples(self, tuple_list):
         for t in tuple_list:
             self.inputs.append(t[1]) # input
+        self._hash = None
     
     def outputs_to_tuples(self):
         res = []
@@ -88,6 +108,7 @@ class Transaction:
     def load_outputs_from_tuples(self, tuple_list):
         for t in tuple_list:
             self.outputs.append({'address':t[2], 'amount':t[3]})
+        self._hash = None
     
     @classmethod
     def from_tuple(self, tup):
@@ -96,6 +117,61 @@ class Transaction:
         t.signature = [tup[1], tup[2]]
         return t
 
+class PublicKeyCache(LRUCache):
+    '''
+    PEM public key -> [loaded key, blockchain address], each computed on first
+    use. Hot senders sign many transactions with the same key, this avoids
+    parsing and hashing their PEM every time.
+    '''
+    def entry(self, pem):
+        entry = self.get(pem)
+        if entry is None:
+            entry = [None, sha256(pem.encode()).hexdigest()]
+            self.put(pem, entry)
+        return entry
+
+    def public_key(self, pem):
+        entry = self.entry(pem)
+        if entry[0] is None:
+            entry[0] = crypto.public_deserialized(pem) # ValueError if malformed
+        return entry[0]
+
+    def address(self, pem):
+        return self.entry(pem)[1]
+
+PUBLIC_KEYS = PublicKeyCache(4096)
+VERIFIED = LRUCache(10000) # Transaction.verification_key() -> bool
+
+def verify_many(transactions: list[Transaction]):
+    '''
+    Verifies the signatures of many transactions at once, on the crypto
+    thread pool. Results are cached, a transaction verified when it entered
+    the pool is not verified again when its block arrives.
+    '''
+    results = [False]*len(transactions)
+    pending = [] # (index, verification key)
+    jobs = []
+    for i, t in enumerate(transactions):
+        if (not t.signature[0]) or (not t.signature[1]):
+            continue
+        key = t.verification_key()
+        cached = VERIFIED.get(key)
+        if cached is not None:
+            results[i] = cached
+            continue
+        try:
+            public_key = PUBLIC_KEYS.public_key(t.signature[0])
+        except ValueError: # malformed key
+            VERIFIED.put(key, False)
+            continue
+        pending.append((i, key))
+        jobs.append((t.signature[1], t.hash().encode(), public_key))
+
+    for (i, key), valid in zip(pending, crypto.verify_many(jobs)):
+        VERIFIED.put(key, valid)
+        results[i] = valid
+    return results
+
 class Address:
     def __init__(self, priv_key=None):
         if not priv_key:
@@ -109,10 +185,9 @@ class Address:
     @classmethod
     def generate_blockchain_address(self, public_key):
         if type(public_key) == str:
-            pem = public_key
-        else:
-            pem = crypto.public_serialized(public_key)
+            return PUBLIC_KEYS.address(public_key)
         
+        pem = crypto.public_serialized(public_key)
         return sha256(pem.encode()).hexdigest()
     
     def sign(self, str_data):
@@ -122,59 +197,94 @@ class Address:
         )
 
 class Merkle:
+    '''
+    Leaves are kept sorted, so the root does not depend on insertion order.
+    Adding leaves only marks the branches right of the first changed position
+    as stale; they are rebuilt on the next root() or proof(). Proofs look
+    leaves up in a hash -> position map and walk up by index, O(log n).
+    '''
     def __init__(self, _list=None):
-        self.l = _list
+        self.l = sorted(_list) if _list else []
         self.levels = []
+        self.positions = None # leaf hash -> position, rebuilt on demand
+        self.stale = None # first leaf position whose branch must be rebuilt
 
-        if _list:
+        if self.l:
             self.recalc()
     
     def add(self, item: str):
         '''
         Items ARE EXPECTED TO BE HASHED before being added to the list
         '''
-        if not self.l:
-            self.l = [item]
-        else:
-            self.l.append(item)
-        self.recalc()
-    
-    def recalc(self):
+        position = bisect_right(self.l, item)
+        self.l.insert(position, item)
+        self.mark_stale(position)
+
+    def extend(self, items):
+        if not items:
+            return
+        self.l.extend(items)
         self.l.sort()
-        self.levels = [tuple(self.l)] # reset, first level
-        while len(self.levels[-1]) > 1:
-            nextLevel = []
-            pair = []
-            for i in self.levels[-1]:
-                pair.append(i)
-                if len(pair) == 2:
-                    nextLevel.append(
-                        sha256((pair[0] + pair[1]).encode())
-                        .hexdigest()
-                    )
-                    pair = []
-            if len(pair) == 1:
-                nextLevel.append(pair[0])
-            self.levels.append(tuple(nextLevel))
+        self.mark_stale(bisect_left(self.l, min(items)))
+
+    def mark_stale(self, position):
+        self.positions = None
+        if (self.stale is None) or (position < self.stale):
+            self.stale = position
+    
+    def recalc(self, start=0):
+        '''Rebuilds the branches of the leaves from position `start` on'''
+        if not self.levels:
+            start = 0
+        self.levels[0:1] = [self.l] # first level
+        k = 0
+        while len(self.levels[k]) > 1:
+            level = self.levels[k]
+            start = start//2 # first parent to rebuild
+            if k+1 < len(self.levels):
+                nextLevel = self.levels[k+1][:start]
+            else:
+                nextLevel = []
+            for i in range(2*start, len(level)-1, 2):
+                nextLevel.append(
+                    sha256((level[i] + level[i+1]).encode())
+                    .hexdigest()
+                )
+            if len(level)%2 != 0:
+                nextLevel.append(level[-1])
+            self.levels[k+1:k+2] = [nextLevel]
+            k += 1
+        del self.levels[k+1:]
+        self.stale = None
+
+    def update(self):
+        if self.stale is not None:
+            self.recalc(self.stale)
     
     def root(self):
+        self.update()
+        if not self.l:
+            return None
         return self.levels[-1][0]
     
     def proof(self, hash):
+        self.update()
+        if self.positions is None:
+            # first position of each hash, as list.index would find it
+            self.positions = {h: i for i, h in reversed(list(enumerate(self.l)))}
+        ind = self.positions.get(hash)
+        if ind is None:
+            return None
+
         res = {
             'root': self.root(),
             'path':[]
         }
-        for l in range(len(self.levels[:-1])):
-            level = self.levels[l]
-            try:
-                ind = level.index(hash)
-            except ValueError:
-                return None
+        for level in self.levels[:-1]:
             if (ind == len(level)-1) and (len(level)%2 != 0):
                 # last hash with no pairs just goes up to the next level
-                continue
-            if ind%2 == 0:
+                pass
+            elif ind%2 == 0:
                 res['path'].append(
                     ('right', level[ind+1])
                 )
@@ -182,34 +292,60 @@ class Merkle:
                 res['path'].append(
                     ('left', level[ind-1])
                 )
-            hash = self.levels[l+1][int(ind/2)]
+            ind //= 2
         return res
     
     def __iter__(self):
         return self.l.__iter__()
 
+SHORT_ID_LENGTH = 16 # hex chars of the transaction hashes in compact blocks
+
+def short_id(tx_hash):
+    return tx_hash[:SHORT_ID_LENGTH]
+
 class Block:
+    HASHED = ('transactionsRoot', 'timestamp', 'nonce', 'prevHash')
+
     def __init__(self, prevHash=None):
-        self.transactionsRaw = [] # transaction dicts
+        self.transactions = [] # Transaction objects
         self.transactionsTree = Merkle() # merkle tree (transaction hashes)
         self.transactionsRoot = None # root of the merkle tree
         self.timestamp = int(time())
         self.nonce = 0
         self.prevHash = prevHash
 
+    def __setattr__(self, name, value):
+        if name in self.HASHED:
+            object.__setattr__(self, '_hash', None)
+        object.__setattr__(self, name, value)
+
+    @property
+    def transactionsRaw(self):
+        # transaction dicts
+        return [t.to_dict() for t in self.transactions]
+
     def addTransaction(self, transaction: Transaction):
         transaction_hash = transaction.hash()
         self.transactionsTree.add(transaction_hash)
-        self.transactionsRaw.append(transaction.to_dict())
+        self.transactions.append(transaction)
+        self.transactionsRoot = self.transactionsTree.root()
+
+    def addTransactions(self, transactions: list[Transaction]):
+        if not transactions:
+            return
+        self.transactionsTree.extend([t.hash() for t in transactions])
+        self.transactions.extend(transactions)
         self.transactionsRoot = self.transactionsTree.root()
     
     def hash(self):
-        return sha256(str([
-            self.transactionsRoot,
-            self.timestamp,
-            self.nonce,
-            self.prevHash
-        ]).encode()).hexdigest()
+        if self._hash is None:
+            self._hash = sha256(str([
+                self.transactionsRoot,
+                self.timestamp,
+                self.nonce,
+                self.prevHash
+            ]).encode()).hexdigest()
+        return self._hash
     
     def to_dict(self):
         return {
@@ -219,6 +355,34 @@ class Block:
             'prevHash': self.prevHash
         }
     
+    def header(self):
+        return {
+            'transactionsRoot': self.transactionsRoot,
+            'timestamp': self.timestamp,
+            'nonce': self.nonce,
+            'prevHash': self.prevHash
+        }
+
+    def to_compact(self):
+        '''
+        Header and short ids of the transactions, for peers holding them in
+        their mempool already. The coinbase can not be there, it is sent whole.
+        '''
+        return {
+            'header': self.header(),
+            'short_ids': [short_id(t.hash()) for t in self.transactions],
+            'prefilled': [[i, t.to_dict()] for i, t in enumerate(self.transactions) if not t.inputs]
+        }
+
+    @staticmethod
+    def from_header(dct):
+        return Block.from_tuple((
+            dct['transactionsRoot'], 
+            dct['timestamp'], 
+            dct['nonce'], 
+            dct['prevHash']
+        ))
+    
     @staticmethod
     def from_dict(dct):
         b = Block()
@@ -226,8 +390,7 @@ class Block:
         b.nonce = dct['nonce']
         b.prevHash = dct['prevHash']
 
-        for td in dct['transactions']:
-            b.addTransaction(Transaction.from_dict(td))
+        b.addTransactions([Transaction.from_dict(td) for td in dct['transactions']])
 
         return b
 
@@ -271,6 +434,17 @@ def difficulty(timeLast, timeNew):
         return inf
     return floor(500/ ((timeNew-timeLast) - 30) )
 
+# WORK of a block: expected number of hashes to find it (difficulty = leading hex zeros).
+def block_work(timeLast, timeNew):
+    return 16**difficulty(timeLast, timeNew)
+
+# WORK of a chain: sum of the work of its blocks (after the first one).
+def chain_work(blocks: list[Block]):
+    return sum(
+        block_work(blocks[i-1].timestamp, blocks[i].timestamp) 
+        for i in range(1, len(blocks))
+    )
+
 # REWARD: 50 coins, halved every year.
 def reward(height):
     return int(50000000/(2**(int(height/525960))))
@@ -292,62 +466,215 @@ class InvalidBlockTransaction(Exception):
         super().__init__(
             'Transaction ' + transaction.hash() + ' es not valid in block ' + block.hash()
         )
+        self.block = block
+        self.transaction = transaction
+
+class _ThreadOwner:
+    '''Held in the thread local state of SQLDatabase, finalized when its thread ends'''
 
 class SQLDatabase:
-    def __init__(self, filename):
+    '''
+    Long lived SQLite connections, one per thread (p2pnetwork callbacks run
+    on their own threads), closed when their thread ends. Statements are
+    prepared once per connection and reused through the sqlite3 statement
+    cache.
+
+    Entering the context opens a transaction scope. Scopes can be nested,
+    only the outermost one commits (or rolls back, if an exception was raised).
+
+    pragmas ({name: value}, e.g. journal_mode, synchronous, cache_size) are
+    set on every new connection.
+
+    on_end registers callbacks run when the current transaction ends, to
+    keep in memory state in step with what was committed.
+
+    close closes the connections of other threads too: those inside a scope
+    are closed when it ends, so they are never closed while in use.
+    '''
+    def __init__(self, filename, pragmas=None):
         self.filename = filename
-    
+        self.pragmas = pragmas or {}
+        self.local = threading.local()
+        self.connections = set() # open
+        self.busy = set() # inside a scope
+        self.connections_lock = threading.RLock()
+
+    @property
+    def connection(self):
+        connection = self.local.__dict__.get('connection')
+        if (connection is None) or ((connection not in self.connections) and not self.in_transaction): # none or closed
+            connection = sqlite3.connect(
+                self.filename,
+                isolation_level=None, # transactions are handled by the scopes
+                check_same_thread=False,
+                cached_statements=256
+            )
+            for name, value in self.pragmas.items():
+                connection.execute(f'PRAGMA {name} = {value}')
+            self.local.connection = connection
+            self.local.cursor = connection.cursor()
+            self.local.depth = 0
+            # the thread local state is dropped when the thread ends, and the
+            # connection closed with it (a thread per peer, sync, ...)
+            self.local.owner = _ThreadOwner()
+            weakref.finalize(self.local.owner, self._release, connection)
+            with self.connections_lock:
+                self.connections.add(connection)
+        return self.local.connection
+
+    def _release(self, connection):
+        with self.connections_lock:
+            self.connections.discard(connection)
+        connection.close()
+
+    @property
+    def cursor(self):
+        self.connection
+        return self.local.cursor
+
+    @property
+    def in_transaction(self):
+        '''True inside a scope of this thread'''
+        return self.local.__dict__.get('depth', 0) > 0
+
+    def on_end(self, callback):
+        '''callback(committed) runs once the transaction of the current scope ends'''
+        self.local.on_end.append(callback)
+
     def __enter__(self):
-        self.connection = sqlite3.connect(self.filename)
-        self.cursor = self.connection.cursor()
-        
+        if not self.in_transaction:
+            with self.connections_lock:
+                self.connection.execute('BEGIN')
+                self.busy.add(self.connection)
+            self.local.on_end = []
+        self.local.depth += 1
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connection.commit()
-        self.connection.close()
+        connection = self.local.connection
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            committed = False
+            try:
+                if exc_type is None:
+                    try:
+                        connection.execute('COMMIT')
+                        committed = True
+                    except sqlite3.Error: # e.g. busy: the transaction is still open
+                        if connection.in_transaction:
+                            connection.execute('ROLLBACK')
+                        raise
+                else:
+                    connection.execute('ROLLBACK')
+            finally:
+                with self.connections_lock:
+                    self.busy.discard(connection)
+                    if connection not in self.connections: # closed meanwhile
+                        connection.close()
+                callbacks, self.local.on_end = self.local.on_end, []
+                for callback in callbacks:
+                    callback(committed)
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections - self.busy:
+                connection.close()
+            self.connections = set()
+
+# Block columns Block.from_tuple reads, hash last
+BLOCK_COLUMNS = 'transactions_root, timestamp, nonce, prevhash, hash'
 
 class BlockChain:
-    def __init__(self, dbfilename, genesisBlock: Block = None, onlyHeaders=False):
+    def __init__(self, dbfilename, genesisBlock: Block = None, onlyHeaders=False, fullVerify=False, pragmas=None):
         self.dbfilename = dbfilename
-        with SQLDatabase(self.dbfilename) as database:
-            database.cursor.executescript(SETUP)
+        self.onlyHeaders = onlyHeaders # store and validate block headers only, no transactions
+        self.db = SQLDatabase(self.dbfilename, pragmas)
+        self.lock = threading.RLock() # block connection / disconnection
+        self.address_utxos = LRUCache(256) # address -> (tip hash, its unspent outputs), see get_utxos_for
+        # committed blocks, in memory. Blocks and headers given out from them
+        # are shared: read only. See lastBlock, getBlock and stage.
+        self.tip = None # (height, last block)
+        self.blocks = LRUCache(64) # height and hash -> (height, block)
+        self.headers = LRUCache(4096) # height -> header
+        self.pending = threading.local() # changes of the transaction of this thread, not committed yet
 
-        if not self.verify(genesisBlock):
+        self.db.cursor.executescript(SETUP)
+        self.migrate()
+
+        if not self.verify(genesisBlock, full=fullVerify):
             raise InvalidBlockchain
 
+    def close(self):
+        self.db.close()
+        self.tip = None
+        self.blocks.clear()
+        self.headers.clear()
+
+    def schema_version(self):
+        with self.db as database:
+            return database.cursor.execute('SELECT MAX(version) FROM SchemaVersion').fetchone()[0] or 0
+
+    def migrate(self):
+        '''Upgrades the database schema in place, see SQL_setup.MIGRATIONS'''
+        version = self.schema_version()
+        for v in range(version, len(MIGRATIONS)):
+            with self.db as database:
+                for statement in MIGRATIONS[v]:
+                    if callable(statement):
+                        statement(self)
+                    else:
+                        database.cursor.execute(statement)
+                database.cursor.execute('INSERT INTO SchemaVersion VALUES (?)', (v+1, ))
+
     def length(self):
-        with SQLDatabase(self.dbfilename) as database:
+        with self.db as database:
             database.cursor.execute('''SELECT MAX(ROWID) FROM Block''')
             return database.cursor.fetchone()[0]
 
-    def verify(self, genesisBlock: Block= None):
-        with SQLDatabase(self.dbfilename) as database:
-            database.cursor.execute('''SELECT * FROM Block ORDER BY ROWID''')
-            blocks = database.cursor.fetchall()
-
-            if len(blocks) == 0:
+    def verify(self, genesisBlock: Block= None, full=False):
+        '''
+        Checks the stored block hashes and the links between blocks. Blocks
+        below the verification checkpoint were already checked and are
+        skipped, unless full=True or the checkpoint does not match the chain.
+        Rows are streamed from the database, not loaded all at once.
+        '''
+        with self.db as database:
+            if not self.length():
                 b = genesisBlock if genesisBlock else Block()
-                database.cursor.execute(
-                    'INSERT INTO Block VALUES (?, ?, ?, ?, ?)',
-                    b.to_tuple()
-                )
-            else:
-                for i in range(len(blocks)):
-                    if i == 0:
-                        continue
-                    current = Block.from_tuple(blocks[i])
-                    last = Block.from_tuple(blocks[i-1])
-
-                    if current.hash() != blocks[i][-1]:
-                        return False
-                    if last.hash() != blocks[i-1][-1]:
-                        return False
-                    if not self.valid(last, current):
-                        return False
+                self.write_block(b, None)
+                self.set_checkpoint(0, b.hash())
+                return True
+
+            start = 1 # first block height whose link to its parent is checked
+            checkpoint = database.cursor.execute('SELECT height, hash FROM Checkpoint').fetchone()
+            if checkpoint and not full:
+                block = database.cursor.execute(
+                    f'SELECT {BLOCK_COLUMNS} FROM Block WHERE ROWID = (?)', (checkpoint[0]+1, )
+                ).fetchone()
+                if block and (Block.from_tuple(block).hash() == checkpoint[1]):
+                    start = max(checkpoint[0], 1)
+
+            last = None
+            for row in database.connection.execute(
+                f'SELECT {BLOCK_COLUMNS} FROM Block WHERE ROWID >= (?) ORDER BY ROWID', (start, )
+                ): # from the parent of `start`
+                current = Block.from_tuple(row)
+                if current.hash() != row[-1]:
+                    return False
+                if last and not self.valid(last, current):
+                    return False
+                last = current
+
+            self.set_checkpoint(self.length()-1, last.hash())
         
         return True
 
+    def set_checkpoint(self, height, block_hash):
+        '''Blocks up to `height` are verified'''
+        with self.db as database:
+            database.cursor.execute('DELETE FROM Checkpoint')
+            database.cursor.execute('INSERT INTO Checkpoint VALUES (?, ?)', (height, block_hash))
+
     @staticmethod
     def valid(lastBlock: Block,  newBlock: Block):
         if lastBlock.hash() != newBlock.prevHash:
@@ -361,99 +688,308 @@ class BlockChain:
             return False
         return True
     
-    def insertNewBlock(self, newBlock: Block):
-        if not self.valid(self.lastBlock(), newBlock):
-            raise InvalidBlock(newBlock)
-
-        if newBlock.transactionsRaw != []:
-            utxos = self.get_utxos()
-
-            fees = 0
-            for i in range(1, len(newBlock.transactionsRaw)): # transctions after coinbase
-                t = Transaction.from_dict(newBlock.transactionsRaw[i])
-                for _in in t.inputs: # any other transaction
-                    if not _in in utxos.keys(): # already spent, or unexistent
-                        raise InvalidBlockTransaction(t, newBlock)
-                    if (
-                        utxos[_in]['address'] != 
-                        Address.generate_blockchain_address(t.signature[0])
-                        ): # unspent, but don't belong to the sender
-                        raise InvalidBlockTransaction(t, newBlock)
-                    fees += utxos[_in]['amount']
-                for out in t.outputs:
-                    fees -= out['amount']
-            
-            # coinbase transaction
-            t = Transaction.from_dict(newBlock.transactionsRaw[0])
-            rew = reward(self.length()-1) + fees
-            if t.inputs != []:
-                raise InvalidBlockTransaction(t, newBlock)
-            if len(t.outputs) != 1:
-                raise InvalidBlockTransaction(t, newBlock)
-            if t.outputs[0]['amount'] > rew:
-                raise InvalidBlockTransaction(t, newBlock)
-
-        with SQLDatabase(self.dbfilename) as database:
+    def write_block(self, newBlock: Block, lastBlock: Block):
+        '''Block row, with the work of the chain up to it (lastBlock is None for the genesis)'''
+        work = 0
+        if lastBlock is not None:
+            work = self.work() + block_work(lastBlock.timestamp, newBlock.timestamp)
+        with self.db as database:
             database.cursor.execute(
-                'INSERT INTO Block VALUES (?, ?, ?, ?, ?)',
-                newBlock.to_tuple()
+                f'INSERT INTO Block ({BLOCK_COLUMNS}, work) VALUES (?, ?, ?, ?, ?, ?)',
+                newBlock.to_tuple() + (str(work), )
             )
-        
-            for t in newBlock.transactionsRaw:
-                t = Transaction.from_dict(t)
-                proof = newBlock.transactionsTree.proof(t.hash())
-                if not proof:
+
+    def backfill_work(self):
+        '''Stores the work of the chain up to each block, for chains stored before it was (migration 6)'''
+        with self.db as database:
+            work, last, rows = 0, None, []
+            for rowid, timestamp in database.connection.execute('SELECT ROWID, timestamp FROM Block ORDER BY ROWID'):
+                if last is not None:
+                    work += block_work(last, timestamp)
+                rows.append((str(work), rowid))
+                last = timestamp
+            database.cursor.executemany('UPDATE Block SET work = (?) WHERE ROWID = (?)', rows)
+
+    def insertNewBlock(self, newBlock: Block):
+        with self.lock, self.db as database:
+            last = self.lastBlock()
+            if not self.valid(last, newBlock):
+                raise InvalidBlock(newBlock)
+            height = self.length()
+
+            if self.onlyHeaders:
+                self.write_block(newBlock, last)
+                self.set_checkpoint(height, newBlock.hash())
+                self.stage((height, newBlock), connected=(height, newBlock))
+                return
+
+            if newBlock.transactionsRoot != newBlock.transactionsTree.root(): # header without its body
+                raise InvalidBlock(newBlock)
+            if len({t.hash() for t in newBlock.transactions}) != len(newBlock.transactions): # same transaction twice
+                raise InvalidBlock(newBlock)
+
+            block_hash = newBlock.hash()
+            undo = [] # outputs spent by the block
+
+            if newBlock.transactions != []:
+                for t, valid in zip(newBlock.transactions[1:], verify_many(newBlock.transactions[1:])):
+                    if not valid:
+                        raise InvalidBlockTransaction(newBlock, t)
+
+                spent = set()
+
+                fees = 0
+                for t in newBlock.transactions[1:]: # transctions after coinbase
+                    for _in in t.inputs: # any other transaction
+                        utxo = self.get_utxo(_in)
+                        if (not utxo) or (_in in spent): # already spent, or unexistent
+                            raise InvalidBlockTransaction(newBlock, t)
+                        if (
+                            utxo['address'] != 
+                            Address.generate_blockchain_address(t.signature[0])
+                            ): # unspent, but don't belong to the sender
+                            raise InvalidBlockTransaction(newBlock, t)
+                        spent.add(_in)
+                        undo.append((block_hash, _in, utxo['transaction'], utxo['address'], utxo['amount']))
+                        fees += utxo['amount']
+                    for out in t.outputs:
+                        fees -= out['amount']
+            
+                # coinbase transaction
+                t = newBlock.transactions[0]
+                rew = reward(height-1) + fees
+                if t.inputs != []:
                     raise InvalidBlockTransaction(newBlock, t)
-                database.cursor.execute(
-                    'INSERT INTO TInBlock VALUES (?, ?)',
-                    (t.hash(), newBlock.hash())
-                )
-                database.cursor.execute(
-                    'INSERT INTO TTransaction VALUES (?, ?, ?, ?)',
-                    (t.timestamp, t.signature[0], t.signature[1], t.hash())
-                )
-                for inp in t.inputs_to_tuples():
-                    database.cursor.execute(
-                        'INSERT INTO TInput VALUES (?, ?)',
-                        inp
-                    )
-                for out in t.outputs_to_tuples():
-                    database.cursor.execute(
-                        'INSERT INTO TOutput VALUES (?, ?, ?, ?)',
-                        out
-                    )
+                if len(t.outputs) != 1:
+                    raise InvalidBlockTransaction(newBlock, t)
+                if t.outputs[0]['amount'] > rew:
+                    raise InvalidBlockTransaction(newBlock, t)
+
+            # rows of the block, written with one executemany per table
+            in_block, transactions, inputs, outputs = [], [], [], []
+            for t in newBlock.transactions:
+                in_block.append((t.hash(), block_hash))
+                transactions.append(t.to_tuple())
+                inputs += t.inputs_to_tuples()
+                outputs += t.outputs_to_tuples()
+
+            self.write_block(newBlock, last)
+            database.cursor.executemany('INSERT INTO TInBlock VALUES (?, ?)', in_block)
+            database.cursor.executemany('INSERT INTO TTransaction VALUES (?, ?, ?, ?)', transactions)
+            database.cursor.executemany('INSERT INTO TInput VALUES (?, ?)', inputs)
+            database.cursor.executemany('DELETE FROM UTXO WHERE hash = (?)', [(i[1], ) for i in inputs])
+            database.cursor.executemany('INSERT INTO Undo VALUES (?, ?, ?, ?, ?)', undo)
+            database.cursor.executemany('INSERT INTO TOutput VALUES (?, ?, ?, ?)', outputs)
+            database.cursor.executemany('INSERT INTO UTXO VALUES (?, ?, ?, ?)', outputs)
+
+            self.set_checkpoint(height, newBlock.hash())
+            self.stage((height, newBlock), connected=(height, newBlock))
+
+    def writing(self):
+        '''True if this thread connected or disconnected blocks it did not commit yet'''
+        return hasattr(self.pending, 'tip')
+
+    def stage(self, tip, connected=None, removed=None):
+        '''
+        Records a change of the current transaction: its new tip, and the
+        (height, block) connected or removed. The tip and the caches follow
+        once it commits, and stay as they were if it rolls back. Until then
+        other threads see the committed chain, as they do in the database.
+        '''
+        if not self.writing():
+            self.pending.connected, self.pending.removed = [], []
+            self.db.on_end(self.end_transaction)
+        self.pending.tip = tip
+        if connected:
+            self.pending.connected.append(connected)
+        if removed:
+            self.pending.connected = [c for c in self.pending.connected if c[0] != removed[0]]
+            self.pending.removed.append(removed)
+
+    def end_transaction(self, committed):
+        tip, connected, removed = self.pending.tip, self.pending.connected, self.pending.removed
+        del self.pending.tip, self.pending.connected, self.pending.removed
+        if not committed:
+            return
+        with self.lock:
+            for height, block in removed:
+                self.blocks.pop(height)
+                self.blocks.pop(block.hash())
+                self.headers.pop(height)
+            for height, block in connected:
+                self.cache_block(height, block)
+            self.tip = tip
+
+    def cache_block(self, height, block):
+        self.blocks.put(height, (height, block))
+        self.blocks.put(block.hash(), (height, block))
+        self.headers.put(height, Block.from_header(block.header()))
     
+    def insertNewBlocks(self, blocks: list[Block]):
+        '''Connects blocks in order, in a single database transaction: all or none'''
+        with self.lock, self.db:
+            for b in blocks:
+                self.insertNewBlock(b)
+
     def get_utxos(self):
         utxos = {}
-        with SQLDatabase(self.dbfilename) as database:
-            utxos_tuple = database.connection.execute('''
-            SELECT * FROM TOutput WHERE NOT EXISTS (SELECT * FROM TInput WHERE TInput.utxo_hash = TOutput.hash)
-            ''').fetchall()
+        with self.db as database:
+            utxos_tuple = database.connection.execute('SELECT * FROM UTXO').fetchall()
         for i in utxos_tuple:
             utxos[i[0]] = {'transaction':i[1], 'amount':i[3], 'address':i[2]} # utxo_hash, tx_hash, utxo_address, utxo_quant
         return utxos
 
+    def get_utxos_for(self, address):
+        '''
+        Unspent outputs of address, same format as get_utxos. Cached along
+        with the hash of the last block they were read at, and valid while
+        it is still the last one in the database. The database is checked,
+        not the in memory tip: wallet.py reads the chain another process (the
+        node) connects blocks to.
+        '''
+        with self.db as database:
+            tip = database.cursor.execute('SELECT hash FROM Block ORDER BY ROWID DESC LIMIT 1').fetchone()
+            cached = self.address_utxos.get(address)
+            if (cached is None) or (cached[0] != tip):
+                rows = database.connection.execute(
+                    'SELECT * FROM UTXO WHERE address = (?)', (address, )
+                ).fetchall()
+                cached = (tip, {i[0]: {'transaction':i[1], 'amount':i[3], 'address':i[2]} for i in rows})
+                self.address_utxos.put(address, cached)
+        return dict(cached[1])
+
+    def balance(self, address):
+        return sum(u['amount'] for u in self.get_utxos_for(address).values())
+
+    def get_utxo(self, utxo_hash):
+        with self.db as database:
+            i = database.connection.execute(
+                'SELECT * FROM UTXO WHERE hash = (?)', (utxo_hash, )
+            ).fetchone()
+        if not i:
+            return None
+        return {'transaction':i[1], 'amount':i[3], 'address':i[2]}
+
+    def current_tip(self):
+        '''(height, last block), from memory once known'''
+        tip = getattr(self.pending, 'tip', None) or self.tip
+        if tip is None:
+            with self.lock:
+                height = self.length()-1
+                tip = (height, self.load_block(height))
+                if not self.db.in_transaction: # committed
+                    self.tip = tip
+        return tip
+
     def lastBlock(self):
-        return self.getBlock(self.length()-1)
+        return self.current_tip()[1]
     
     def getBlock(self, height):
-        height += 1
-        try:
-            with SQLDatabase(self.dbfilename) as database:
-                t_block = database.cursor.execute('SELECT * FROM Block WHERE ROWID = (?)', (height, )).fetchall()[0]
-                block = Block.from_tuple(t_block)
-                block_transaction_hashes = database.cursor.execute('SELECT * FROM TInBlock WHERE block_hash = (?)', (block.hash(), )).fetchall()
-            for (th, bh) in block_transaction_hashes:
-                trans = self.get_transaction(th)
-                block.addTransaction(trans)
-        except IndexError:
+        '''Block at height, None if there is none. Recent blocks come from memory.'''
+        tip = self.current_tip()
+        if height == tip[0]:
+            return tip[1]
+        if self.writing(): # the caches are behind this transaction
+            return self.load_block(height)
+        entry = self.blocks.get(height)
+        if entry is not None:
+            return entry[1]
+        with self.lock: # nothing read before a block is committed gets cached after it
+            block = self.load_block(height)
+            if (block is not None) and not self.db.in_transaction:
+                self.cache_block(height, block)
+        return block
+
+    def load_block(self, height):
+        blocks = self.getBlocks(height, height+1)
+        if not blocks:
             return None
+        return blocks[0]
 
-        return block
+    def getBlocks(self, start, end):
+        '''
+        Blocks with height in [start, end). Transactions, inputs and outputs
+        of the whole range are loaded with one query each. CROSS JOIN fixes
+        the join order: Block range first, then the indexes on the hashes.
+        '''
+        start = max(start, 0)
+        if end <= start:
+            return []
+        block_range = (start+1, end) # heights are ROWID-1
+        with self.db as database:
+            block_tuples = database.cursor.execute(
+                f'SELECT {BLOCK_COLUMNS} FROM Block WHERE ROWID >= (?) AND ROWID <= (?) ORDER BY ROWID', 
+                block_range
+            ).fetchall()
+            if not block_tuples:
+                return []
+            transaction_tuples = database.cursor.execute('''SELECT TInBlock.block_hash, TTransaction.* FROM Block 
+                             CROSS JOIN TInBlock ON TInBlock.block_hash = Block.hash 
+                             CROSS JOIN TTransaction ON TTransaction.hash = TInBlock.transaction_hash 
+                             WHERE Block.ROWID >= (?) AND Block.ROWID <= (?) ORDER BY TInBlock.ROWID''',
+                             block_range).fetchall()
+            inputs_tuples = database.cursor.execute('''SELECT TInput.* FROM Block 
+                             CROSS JOIN TInBlock ON TInBlock.block_hash = Block.hash 
+                             CROSS JOIN TInput ON TInput.tx_hash = TInBlock.transaction_hash 
+                             WHERE Block.ROWID >= (?) AND Block.ROWID <= (?) ORDER BY TInput.ROWID''',
+                             block_range).fetchall()
+            outputs_tuples = database.cursor.execute('''SELECT TOutput.* FROM Block 
+                             CROSS JOIN TInBlock ON TInBlock.block_hash = Block.hash 
+                             CROSS JOIN TOutput ON TOutput.tx_hash = TInBlock.transaction_hash 
+                             WHERE Block.ROWID >= (?) AND Block.ROWID <= (?) ORDER BY TOutput.ROWID''',
+                             block_range).fetchall()
+
+        transactions = {} # tx_hash: Transaction
+        block_transactions = {} # block_hash: [Transaction, ...]
+        for t in transaction_tuples:
+            trans = Transaction.from_tuple(t[1:])
+            transactions[t[-1]] = trans
+            block_transactions.setdefault(t[0], []).append(trans)
+        for i in inputs_tuples:
+            transactions[i[0]].load_inputs_from_tuples([i])
+        for o in outputs_tuples:
+            transactions[o[1]].load_outputs_from_tuples([o])
+
+        blocks = []
+        for t_block in block_tuples:
+            block = Block.from_tuple(t_block)
+            block.addTransactions(block_transactions.get(t_block[-1], []))
+            blocks.append(block)
+        return blocks
+
+    def getHeaders(self, start, end):
+        '''Headers (blocks without transactions) with height in [start, end)'''
+        start = max(start, 0)
+        if end <= start:
+            return []
+        if not self.writing():
+            headers = [self.headers.get(height) for height in range(start, end)]
+            if all(h is not None for h in headers):
+                return headers
+        with self.lock:
+            with self.db as database:
+                rows = database.cursor.execute(
+                    f'SELECT ROWID, {BLOCK_COLUMNS} FROM Block WHERE ROWID >= (?) AND ROWID <= (?) ORDER BY ROWID', 
+                    (start+1, end)
+                ).fetchall()
+            headers = [Block.from_tuple(row[1:]) for row in rows]
+            if not self.db.in_transaction: # committed
+                for row, header in zip(rows, headers):
+                    self.headers.put(row[0]-1, header) # heights are ROWID-1
+        return headers
+
+    def work(self, height=None):
+        '''Work of the chain up to height (the last block by default), stored with each block: O(1)'''
+        with self.db as database:
+            if height is None:
+                row = database.cursor.execute('SELECT work FROM Block ORDER BY ROWID DESC LIMIT 1').fetchone()
+            else:
+                row = database.cursor.execute('SELECT work FROM Block WHERE ROWID = (?)', (height+1, )).fetchone()
+        return int(row[0]) if row else 0
 
     def get_transaction(self, t_hash):
         try:
-            with SQLDatabase(self.dbfilename) as database:
+            with self.db as database:
                 transaction_tuple = database.cursor.execute('SELECT * FROM TTransaction WHERE hash = (?)', (t_hash, )).fetchall()[0]
                 inputs_tuple = database.cursor.execute('SELECT * FROM TInput WHERE tx_hash = (?)', (t_hash,)).fetchall()
                 outputs_tuple = database.cursor.execute('SELECT * FROM TOutput WHERE tx_hash = (?)', (t_hash,)).fetchall()
@@ -467,27 +1003,58 @@ class BlockChain:
         return trans
     
     def remove_last_block(self):
-        with SQLDatabase(self.dbfilename) as database:
-            block_hash = self.lastBlock().hash()
+        '''Disconnects the last block, returns it'''
+        with self.lock, self.db as database:
+            height, last_block = self.current_tip()
+            block_hash = last_block.hash()
+            # outputs spent by the block become unspent again
             database.cursor.execute(
-                'DELETE * FROM Blocks WHERE hash = (?)',
-                block_hash
+                'INSERT INTO UTXO SELECT hash, tx_hash, address, amount FROM Undo WHERE block_hash = (?)', 
+                (block_hash, )
             )
-            database.cursor.execute('''DELETE * FROM TTransaction WHERE EXISTS 
-                             (SELECT * FROM TInBlock WHERE transaction_hash = TTransaction.hash AND block_hash = (?) )''',
-                             block_hash)
-            database.cursor.execute('''DELETE * FROM TInput WHERE EXISTS 
-                             (SELECT * FROM TInBlock WHERE transaction_hash = TInput.tx_hash AND block_hash = (?) )''',
-                             block_hash)
-            database.cursor.execute('''DELETE * FROM TTransaction WHERE EXISTS 
-                             (SELECT * FROM TInBlock WHERE transaction_hash = TOutput.tx_hash AND block_hash = (?) )''',
-                             block_hash)
-            database.cursor.execute('DELETE * FROM TInBlock WHERE block_hash = (?)', block_hash)
+            database.cursor.execute('DELETE FROM Undo WHERE block_hash = (?)', (block_hash, ))
+            database.cursor.execute('''DELETE FROM UTXO WHERE tx_hash IN 
+                             (SELECT transaction_hash FROM TInBlock WHERE block_hash = (?))''',
+                             (block_hash, ))
+            database.cursor.execute('''DELETE FROM TInput WHERE tx_hash IN 
+                             (SELECT transaction_hash FROM TInBlock WHERE block_hash = (?))''',
+                             (block_hash, ))
+            database.cursor.execute('''DELETE FROM TOutput WHERE tx_hash IN 
+                             (SELECT transaction_hash FROM TInBlock WHERE block_hash = (?))''',
+                             (block_hash, ))
+            database.cursor.execute('''DELETE FROM TTransaction WHERE hash IN 
+                             (SELECT transaction_hash FROM TInBlock WHERE block_hash = (?))''',
+                             (block_hash, ))
+            database.cursor.execute('DELETE FROM TInBlock WHERE block_hash = (?)', (block_hash, ))
+            database.cursor.execute('DELETE FROM Block WHERE hash = (?)', (block_hash, ))
+            self.set_checkpoint(height-1, last_block.prevHash)
+            self.stage((height-1, self.load_block(height-1)), removed=(height, last_block))
+            return last_block
+
+    def reorganize(self, fork_height, blocks: list[Block]):
+        '''
+        Replaces the blocks after fork_height with blocks, in a single
+        database transaction: if any of them is invalid, the chain is left
+        untouched. Returns the disconnected blocks, last one first.
+        '''
+        with self.lock, self.db:
+            disconnected = []
+            while self.current_tip()[0] > fork_height:
+                disconnected.append(self.remove_last_block())
+            self.insertNewBlocks(blocks)
+            return disconnected
     
+    def get_height(self, block_hash):
+        '''Height of the block, None if it is not in the chain'''
+        height, last = self.current_tip()
+        if block_hash == last.hash():
+            return height
+        entry = None if self.writing() else self.blocks.get(block_hash)
+        if entry is not None:
+            return entry[0]
+        with self.db as database:
+            row = database.cursor.execute('SELECT ROWID FROM Block WHERE hash = (?)', (block_hash, )).fetchone()
+        return None if row is None else row[0]-1
+
     def block_exists(self, block_hash):
-        try:
-            with SQLDatabase(self.dbfilename) as database:
-                t_block = database.cursor.execute('SELECT * FROM Block WHERE hash = (?)', (block_hash, )).fetchall()[0]
-                return True
-        except IndexError:
-            return False
\ No newline at end of file
+        return self.get_height(block_hash) is not None
\ No newline at end of file
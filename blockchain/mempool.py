@@ -0,0 +1,172 @@
+'''
+Pool of valid transactions waiting to be included in a block.
+'''
+from blockchain import Transaction, Block, BlockChain, verify_many, reward, short_id, PUBLIC_KEYS
+import threading
+import heapq
+
+class MempoolEntry:
+    def __init__(self, transaction: Transaction, fee):
+        self.transaction = transaction
+        self.hash = transaction.hash()
+        self.fee = fee
+        self.size = len(transaction.to_json())
+        self.fee_rate = fee/self.size
+
+class Mempool:
+    '''
+    Transactions indexed by hash, and by the outputs they spend (to detect
+    double spends). When full, the lowest fee rate transactions are evicted.
+    '''
+    def __init__(self, blockchain: BlockChain, max_transactions=5000):
+        self.bc = blockchain
+        self.max_transactions = max_transactions
+        self.entries = {} # tx hash -> MempoolEntry
+        self.spends = {} # utxo hash -> hash of the pool transaction spending it
+        self.short_ids = {} # short id -> tx hash, to rebuild compact blocks
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.entries
+
+    def select(self, max_size, max_transactions=None):
+        '''
+        Greedy choice of the entries to mine: highest fee rate first, skipping
+        the ones that do not fit in max_size bytes anymore. Heap based, so
+        O(n + k log n) for k selected entries.
+        '''
+        with self.lock:
+            heap = [(-e.fee_rate, i, e) for i, e in enumerate(self.entries.values())]
+        heapq.heapify(heap)
+
+        selected = []
+        size = 0
+        while heap and ((max_transactions is None) or (len(selected) < max_transactions)):
+            entry = heapq.heappop(heap)[2]
+            if size + entry.size > max_size:
+                continue
+            selected.append(entry)
+            size += entry.size
+        return selected
+
+    def block_template(self, mining_address, max_size, max_transactions=None):
+        '''
+        Next block to mine: a coinbase paying reward and fees to
+        mining_address, then the selected pool transactions. Fees were
+        computed when each transaction entered the pool, nothing is validated
+        again here. max_size counts the pool transactions only.
+        '''
+        entries = self.select(max_size, max_transactions)
+        new_block = Block(prevHash=self.bc.lastBlock().hash())
+        rew = reward(self.bc.length()-1) + sum(e.fee for e in entries)
+        if rew > 0:
+            new_block.addTransaction(Transaction([], [{'address':mining_address, 'amount':rew}]))
+        new_block.addTransactions([e.transaction for e in entries])
+        return new_block
+
+    def check(self, transaction: Transaction):
+        '''
+        Fee of the transaction if it can enter the pool, None otherwise.
+        The signature is not verified here, add does it first.
+        '''
+        if len(set(transaction.inputs)) != len(transaction.inputs):
+            return None
+
+        sender = PUBLIC_KEYS.address(transaction.signature[0])
+        fee = 0
+        for i in transaction.inputs:
+            if i in self.spends: # already spent by a pool transaction
+                return None
+            utxo = self.bc.get_utxo(i)
+            if (not utxo) or (utxo['address'] != sender):
+                return None
+            fee += utxo['amount']
+        
+        for o in transaction.outputs:
+            if o['amount'] < 0:
+                return None
+            fee -= o['amount']
+        
+        if fee < 0:
+            return None
+        return fee
+
+    def add(self, transaction: Transaction):
+        '''
+        True if the transaction entered the pool. The signature is verified
+        without holding any lock. The inputs are checked under the chain lock:
+        no block connects meanwhile, so an output spent by a block never gets
+        in after block_connected ran.
+        '''
+        if transaction.hash() in self.entries:
+            return False
+        if not verify_many([transaction])[0]:
+            return False
+        with self.bc.lock, self.lock:
+            if transaction.hash() in self.entries:
+                return False
+            fee = self.check(transaction)
+            if fee is None:
+                return False
+            entry = MempoolEntry(transaction, fee)
+
+            if len(self.entries) >= self.max_transactions:
+                lowest = min(self.entries.values(), key=lambda e: e.fee_rate)
+                if lowest.fee_rate >= entry.fee_rate:
+                    return False
+                self.remove(lowest.hash)
+
+            self.entries[entry.hash] = entry
+            self.short_ids[short_id(entry.hash)] = entry.hash
+            for i in transaction.inputs:
+                self.spends[i] = entry.hash
+            return True
+
+    def remove(self, tx_hash):
+        with self.lock:
+            entry = self.entries.pop(tx_hash, None)
+            if entry:
+                if self.short_ids.get(short_id(tx_hash)) == tx_hash:
+                    del self.short_ids[short_id(tx_hash)]
+                for i in entry.transaction.inputs:
+                    del self.spends[i]
+            return entry
+
+    def reconstruct(self, compact):
+        '''
+        Transactions of a compact block (Block.to_compact): the prefilled ones,
+        the rest taken from the pool. Returns (transactions, missing indexes),
+        missing transactions are None.
+        '''
+        transactions = [None]*len(compact['short_ids'])
+        for i, t in compact['prefilled']:
+            transactions[i] = Transaction.from_dict(t)
+        with self.lock:
+            for i, s in enumerate(compact['short_ids']):
+                if (transactions[i] is None) and (s in self.short_ids):
+                    transactions[i] = self.entries[self.short_ids[s]].transaction
+        return transactions, [i for i, t in enumerate(transactions) if t is None]
+
+    def block_connected(self, block: Block):
+        '''Drops the transactions included in the block and the ones conflicting with it'''
+        with self.lock:
+            for t in block.transactions:
+                self.remove(t.hash())
+                for i in t.inputs:
+                    if i in self.spends:
+                        self.remove(self.spends[i])
+
+    def block_disconnected(self, block: Block):
+        '''Gives the transactions of a removed block (except the coinbase) back to the pool'''
+        for t in block.transactions[1:]:
+            self.add(t)
+
+    def revalidate(self):
+        '''Drops the transactions that are no longer valid (after the chain was replaced)'''
+        with self.bc.lock, self.lock: # add takes them in this order
+            for entry in list(self.entries.values()):
+                self.remove(entry.hash)
+                self.add(entry.transaction) # back in only if still valid
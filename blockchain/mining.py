@@ -0,0 +1,108 @@
+'''
+Proof of work search, split across a pool of worker processes.
+
+Worker i tries the nonces i, i+N, i+2N, ... (N workers), refreshing the
+timestamp (and so the difficulty) every CHECK_EVERY nonces. A search stops
+as soon as one worker finds a valid hash, or when it is cancelled (new block
+received, new transactions in the pool).
+'''
+from blockchain import Block, difficulty
+from hashlib import sha256
+from time import time, sleep, perf_counter
+import multiprocessing
+import os
+
+CHECK_EVERY = 20000 # nonces tried between cancellation / timestamp checks
+
+class HeaderHasher:
+    '''
+    Block.hash for a fixed transactionsRoot and prevHash. The header text up
+    to the nonce is fed to sha256 once per timestamp, every nonce only hashes
+    the rest from a copy of that state. Hashes are identical to Block.hash.
+    '''
+    def __init__(self, transactionsRoot, prevHash):
+        self.prefix = '[' + repr(transactionsRoot) + ', '
+        self.suffix = (', ' + repr(prevHash) + ']').encode()
+        self.timestamp = None
+        self.state = None
+
+    def hash(self, timestamp, nonce):
+        if timestamp != self.timestamp:
+            self.timestamp = timestamp
+            self.state = sha256((self.prefix + repr(timestamp) + ', ').encode())
+        h = self.state.copy()
+        h.update(b'%d' % nonce + self.suffix)
+        return h.hexdigest()
+
+def _init_worker(cancelled):
+    global _cancelled
+    _cancelled = cancelled
+
+def _search(job):
+    transactionsRoot, prevHash, lastTimestamp, nonce, step = job
+    header_hash = HeaderHasher(transactionsRoot, prevHash).hash
+    hashes = 0
+    while not _cancelled.is_set():
+        timestamp = int(time())
+        dif = difficulty(lastTimestamp, timestamp)
+        if dif > 64: # not mineable yet
+            sleep(0.1)
+            continue
+        target = '0'*dif
+        for i in range(CHECK_EVERY):
+            if header_hash(timestamp, nonce)[:dif] == target:
+                return (nonce, timestamp, hashes+i+1)
+            nonce += step
+        hashes += CHECK_EVERY
+    return (None, None, hashes)
+
+class Miner:
+    def __init__(self, workers=0):
+        self.workers = workers if workers else os.cpu_count()
+        self.cancelled = multiprocessing.Event()
+        self.pool = None
+        self.hashrate = 0 # hashes per second of the last search
+
+    def start(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(
+                self.workers, 
+                initializer=_init_worker, 
+                initargs=(self.cancelled, )
+            )
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def cancel(self):
+        '''Stops the running search (or the next one, if none is running)'''
+        self.cancelled.set()
+
+    def mine(self, lastBlock: Block, newBlock: Block):
+        '''
+        Sets a valid nonce and timestamp on newBlock. Returns False if the
+        search was cancelled before finding one.
+        '''
+        self.start()
+        jobs = [
+            (newBlock.transactionsRoot, newBlock.prevHash, lastBlock.timestamp, i, self.workers) 
+            for i in range(self.workers)
+        ]
+        start = perf_counter()
+        hashes = 0
+        found = None
+        for nonce, timestamp, worker_hashes in self.pool.imap_unordered(_search, jobs):
+            hashes += worker_hashes
+            if (nonce is not None) and (found is None):
+                found = (nonce, timestamp)
+                self.cancelled.set() # stop the other workers
+        self.hashrate = hashes/(perf_counter() - start)
+        self.cancelled.clear()
+
+        if not found:
+            return False
+        newBlock.nonce, newBlock.timestamp = found
+        return True
@@ -0,0 +1,261 @@
+'''
+Compact binary encoding of node messages, an alternative to JSON.
+
+Any JSON-like value (None, bool, int, float, str, list, dict) is encoded
+with a one byte tag. Strings the chain is full of get shorter forms, used
+only when decoding gives back the exact same string:
+- 64 char lowercase hex (hashes, addresses): 32 raw bytes.
+- other lowercase hex (signatures): raw bytes.
+- PEM public keys: DER bytes.
+- uuid4 message ids: 16 raw bytes.
+- well known dict keys: one byte.
+Non-negative ints (amounts, nonces) are varints, floats 8 byte doubles.
+
+Packets go through p2pnetwork, which ends them with 0x04 and treats a final
+0x02 as a compression marker. dumps() escapes both bytes, and prefixes the
+packet with 0xFF, which never appears in UTF-8: p2pnetwork hands the packet
+over as bytes instead of parsing it as JSON.
+'''
+from blockchain.cache import LRUCache
+from base64 import b64encode, b64decode
+from uuid import UUID
+import binascii
+import struct
+
+MAGIC = b'\xff'
+
+NONE, TRUE, FALSE, UINT, NINT, FLOAT, STR, HASH, HEX, PEM, LIST, DICT, KEY, ID = range(14)
+
+# append only: peers must agree on the index of each key
+KEYS = (
+    'code', 'data', 'id', 'response_to',
+    'transactions', 'inputs', 'outputs', 'timestamp', 'signature', 'address', 'amount',
+    'nonce', 'prevHash', 'transactionsRoot',
+    'blocks', 'headers', 'start', 'end', 'hash', 'exists', 'height',
+    'length', 'genesis', 'last', 'started_in', 'only_headers', 'formats',
+    'header', 'short_ids', 'prefilled', 'indexes', 'items',
+    'work',
+)
+KEY_INDEX = {k: i for i, k in enumerate(KEYS)}
+
+PEM_HEADER = '-----BEGIN PUBLIC KEY-----\n'
+PEM_FOOTER = '\n-----END PUBLIC KEY-----\n'
+
+DOUBLE = struct.Struct('>d')
+
+# the same few keys sign most transactions
+DER_TO_PEM = LRUCache(1024)
+PEM_TO_DER = LRUCache(1024)
+
+class WireError(ValueError):
+    pass
+
+def der_to_pem(der):
+    pem = DER_TO_PEM.get(der)
+    if pem is None:
+        body = b64encode(der).decode()
+        pem = PEM_HEADER + '\n'.join(body[i:i+64] for i in range(0, len(body), 64)) + PEM_FOOTER
+        DER_TO_PEM.put(der, pem)
+    return pem
+
+def pem_to_der(pem):
+    '''DER bytes of pem, None if it would not be rebuilt exactly by der_to_pem'''
+    der = PEM_TO_DER.get(pem)
+    if der is not None:
+        return der
+    if not (pem.startswith(PEM_HEADER) and pem.endswith(PEM_FOOTER)):
+        return None
+    try:
+        der = b64decode(pem[len(PEM_HEADER):-len(PEM_FOOTER)])
+    except binascii.Error:
+        return None
+    if der_to_pem(der) != pem:
+        return None
+    PEM_TO_DER.put(pem, der)
+    return der
+
+def hex_to_bytes(s):
+    '''Raw bytes of a lowercase hex string, None for any other string'''
+    if len(s) % 2:
+        return None
+    try:
+        raw = bytes.fromhex(s)
+    except ValueError:
+        return None
+    return raw if raw.hex() == s else None
+
+def uuid_to_bytes(s):
+    if len(s) != 36:
+        return None
+    try:
+        u = UUID(s)
+    except ValueError:
+        return None
+    return u.bytes if str(u) == s else None
+
+def write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, i):
+    n = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, i
+        shift += 7
+
+def write_bytes(out, tag, raw):
+    out.append(tag)
+    write_varint(out, len(raw))
+    out += raw
+
+def write_str(out, s):
+    if len(s) == 64:
+        raw = hex_to_bytes(s)
+        if raw is not None:
+            out.append(HASH)
+            out += raw
+            return
+
+    if s.startswith(PEM_HEADER):
+        der = pem_to_der(s)
+        if der is not None:
+            write_bytes(out, PEM, der)
+            return
+
+    raw = uuid_to_bytes(s)
+    if raw is not None:
+        out.append(ID)
+        out += raw
+        return
+
+    raw = hex_to_bytes(s) if s else None
+    if raw is not None:
+        write_bytes(out, HEX, raw)
+        return
+
+    write_bytes(out, STR, s.encode())
+
+def write(out, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        if value >= 0:
+            out.append(UINT)
+            write_varint(out, value)
+        else:
+            out.append(NINT)
+            write_varint(out, -value - 1)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        write_str(out, value)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        write_varint(out, len(value))
+        for v in value:
+            write(out, v)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        write_varint(out, len(value))
+        for k, v in value.items():
+            if k in KEY_INDEX:
+                out.append(KEY)
+                out.append(KEY_INDEX[k])
+            else:
+                write_bytes(out, STR, k.encode())
+            write(out, v)
+    else:
+        raise WireError(f'can not encode {type(value).__name__}')
+
+def read(data, i):
+    tag = data[i]
+    i += 1
+    if tag == NONE:
+        return None, i
+    if tag == TRUE:
+        return True, i
+    if tag == FALSE:
+        return False, i
+    if tag == UINT:
+        return read_varint(data, i)
+    if tag == NINT:
+        n, i = read_varint(data, i)
+        return -n - 1, i
+    if tag == FLOAT:
+        return DOUBLE.unpack_from(data, i)[0], i + 8
+    if tag == HASH:
+        return bytes(data[i:i+32]).hex(), i + 32
+    if tag == ID:
+        return str(UUID(bytes=bytes(data[i:i+16]))), i + 16
+    if tag == KEY:
+        return KEYS[data[i]], i + 1
+    if tag in (STR, HEX, PEM):
+        n, i = read_varint(data, i)
+        raw = bytes(data[i:i+n])
+        if tag == STR:
+            return raw.decode(), i + n
+        if tag == HEX:
+            return raw.hex(), i + n
+        return der_to_pem(raw), i + n
+    if tag == LIST:
+        n, i = read_varint(data, i)
+        values = []
+        for _ in range(n):
+            v, i = read(data, i)
+            values.append(v)
+        return values, i
+    if tag == DICT:
+        n, i = read_varint(data, i)
+        values = {}
+        for _ in range(n):
+            k, i = read(data, i)
+            values[k], i = read(data, i)
+        return values, i
+    raise WireError(f'unknown tag {tag}')
+
+def encode(value):
+    out = bytearray()
+    write(out, value)
+    return bytes(out)
+
+def decode(data):
+    try:
+        value, i = read(memoryview(data), 0)
+    except (IndexError, TypeError, struct.error, UnicodeDecodeError, ValueError) as e:
+        raise WireError(str(e))
+    if i != len(data):
+        raise WireError('trailing bytes')
+    return value
+
+# escaping of the bytes p2pnetwork reserves (0x04 ends a packet, 0x02 marks
+# compression). Escaped, every 0x1b starts a pair, so plain replaces undo it.
+ESCAPES = ((b'\x1b', b'\x1bC'), (b'\x04', b'\x1bA'), (b'\x02', b'\x1bB'))
+
+def dumps(value):
+    '''Packet ready to be sent through p2pnetwork'''
+    data = encode(value)
+    for byte, escaped in ESCAPES: # 0x1b first
+        data = data.replace(byte, escaped)
+    return MAGIC + data
+
+def is_packet(data):
+    return isinstance(data, bytes) and data[:1] == MAGIC
+
+def loads(packet):
+    if not is_packet(packet):
+        raise WireError('not a wire packet')
+    data = packet[1:]
+    for byte, escaped in reversed(ESCAPES): # 0x1b last
+        data = data.replace(escaped, byte)
+    return decode(data)
@@ -3,6 +3,7 @@ from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.exceptions import InvalidSignature
 from pathlib import Path
 from cryptography.hazmat.primitives import serialization
+from concurrent.futures import ThreadPoolExecutor
 
 def generate_key_pair():
     key_size = 4096  # Should be at least 2048
@@ -66,6 +67,26 @@ def verify(hex_signature, message, public_key):
     except InvalidSignature:
         return False
 
+_verify_pool = None
+
+def _verify_job(job):
+    try:
+        return verify(*job)
+    except ValueError: # malformed signature
+        return False
+
+def verify_many(jobs):
+    '''
+    verify() for a list of (hex_signature, message, public_key) jobs, run on a
+    thread pool (the OpenSSL calls release the GIL). Returns a list of bools.
+    '''
+    global _verify_pool
+    if len(jobs) < 2:
+        return [_verify_job(job) for job in jobs]
+    if _verify_pool is None:
+        _verify_pool = ThreadPoolExecutor(thread_name_prefix='verify')
+    return list(_verify_pool.map(_verify_job, jobs))
+
 def private_to_pem_file(private_key, pem_file, password):
     key_pem_bytes = private_to_pem_bytes(private_key, password)
 
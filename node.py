@@ -2,9 +2,17 @@ from p2pnetwork.node import Node
 from uuid import uuid4
 from json import loads, dumps
 import blockchain
+from blockchain import wire
+from blockchain.mining import Miner
+from blockchain.mempool import Mempool
+from blockchain.cache import LRUCache
 from loguru import logger
-from time import time, sleep
+from time import time, sleep, perf_counter
 from sys import argv
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, wait
+import concurrent.futures
+import threading
+import asyncio
 import os
 
 class Message:
@@ -29,6 +37,9 @@ class Message:
         new.__dict__ = _dict
         return new
     
+    def to_wire(self):
+        return wire.dumps(self.__dict__)
+
     def __repr__(self) -> str:
         return str(self.to_json())
     
@@ -37,119 +48,411 @@ class Message:
         res.response_to = self.id
         return res
 
-def minutesPassed(start):
-    return int((time() - start)/60)
-
-if len(argv) > 1:
-    CONFIG_FILE = argv[1]
-else:
-    CONFIG_FILE = 'nodeconfig.json'
- 
-with open(CONFIG_FILE, 'r') as f:
-    CONFIG = loads(f.read())
-    f.close()
-
-class P2PNode(Node):
-    def __init__(self, host, port, id=None, callback=None, max_connections=0):
-        super(P2PNode, self).__init__(host, port, id, callback, max_connections)
-
-        self.bc = blockchain.BlockChain(CONFIG['blockchain_file'])
-        self.responses = {}
-        self.transaction_pool = []
-
-    def outbound_node_connected(self, connected_node):
-        print("outbound_node_connected: " + connected_node.id)
-
-    def inbound_node_connected(self, connected_node):
-        print("inbound_node_connected: " + connected_node.id)
-        self.send_to_nodes(Message('NEW_NODE', {'id':connected_node.id, 'host':connected_node.host, 'port':int(connected_node.port)}).to_json())
-
-    def inbound_node_disconnected(self, connected_node):
-        print("inbound_node_disconnected: " + connected_node.id)
-
-    def outbound_node_disconnected(self, connected_node):
-        print("outbound_node_disconnected: " + connected_node.id)
-
-    def ask(self, node, message):
-        self.responses[message.id] = None
-        
-        self.send_to_node(node, message.to_json())
+MAX_BLOCKS_PER_MESSAGE = 500
+MAX_HEADERS_PER_MESSAGE = 2000
+
+def load_config(filename='nodeconfig.json'):
+    with open(filename, 'r') as f:
+        return loads(f.read())
+
+class BlockchainNode:
+    '''
+    Protocol of the node, whatever runs the connections: the message
+    handlers, sync, gossip and mining. Subclasses provide all_nodes,
+    send_to_node(node, data) and connect_with_node(host, port), and call
+    node_connected and decode / resolve / handle_message for every packet.
+    Handlers block (database, crypto, asking peers), so they must not run
+    on the thread reading the responses they may wait for.
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.bc = blockchain.BlockChain(
+            self.config['blockchain_file'], 
+            onlyHeaders=self.config.get('only_headers', False), 
+            pragmas=self.config.get('sqlite_pragmas')
+        )
+        self.responses = {} # message id -> Future of the response data
+        self.sync_lock = threading.Lock()
+        self.mempool = Mempool(self.bc, self.config.get('mempool_size', 5000))
+        self.miner = Miner(self.config.get('mining_workers', 0))
+        if not self.bc.onlyHeaders:
+            self.miner.start() # fork the workers before the connection threads exist
+
+        # gossip: announce (INV) then fetch (GETDATA) only what was not seen yet
+        self.seen = LRUCache(self.config.get('seen_cache_size', 50000)) # hashes of the blocks and transactions received
+        self.requested = LRUCache(self.config.get('seen_cache_size', 50000)) # hash -> time of the GETDATA
+        self.gossip_stats = {
+            'inv_sent': 0, 
+            'inv_suppressed': 0, # not announced, the peer has it
+            'getdata_suppressed': 0, # announced, but already seen or requested
+            'duplicates_received': 0 # payloads received again
+        }
+
+    def node_connected(self, connected_node, inbound):
+        self.send_wire_formats(connected_node)
+        if inbound:
+            self.broadcast(Message('NEW_NODE', {'id':connected_node.id, 'host':connected_node.host, 'port':int(connected_node.port)}))
+
+    def send_wire_formats(self, node):
+        # the formats node may send us. Until it tells us its own, it gets JSON
+        formats = ['binary', 'json'] if self.config.get('wire_format', 'binary') == 'binary' else ['json']
+        self.send_message(node, Message('WIRE_FORMATS', {'formats': formats}))
+
+    def send_message(self, node, message):
+        '''Sends message to node, in the format negotiated with it'''
+        if node.info.get('wire') == 'binary':
+            self.send_to_node(node, message.to_wire())
+        else:
+            self.send_to_node(node, message.to_json())
 
-        while not self.responses[message.id]:
-            sleep(0.1)
-        
-        res = dict(self.responses[message.id])
-        del self.responses[message.id]
-        return res
+    def broadcast(self, message):
+        encoded = {}
+        for node in self.all_nodes:
+            wire_format = node.info.get('wire', 'json')
+            if wire_format not in encoded:
+                encoded[wire_format] = message.to_wire() if wire_format == 'binary' else message.to_json()
+            self.send_to_node(node, encoded[wire_format])
+
+    def known(self, node):
+        '''Hashes node is known to have: it announced or sent them, or we did'''
+        if 'known' not in node.info:
+            node.set_info('known', LRUCache(self.config.get('seen_cache_size', 50000)//10))
+        return node.info['known']
+
+    def announce(self, kind, item_hash, exclude=None):
+        '''INV of a block or transaction to the peers that do not have it yet'''
+        message = Message('INV', {'items': [[kind, item_hash]]})
+        for node in self.all_nodes:
+            known = self.known(node)
+            if (node is exclude) or (item_hash in known):
+                self.gossip_stats['inv_suppressed'] += 1
+                continue
+            known.put(item_hash, True)
+            self.gossip_stats['inv_sent'] += 1
+            self.send_message(node, message)
+
+    def received(self, node, item_hash):
+        '''Records a block or transaction sent by node. False if it was seen already'''
+        self.known(node).put(item_hash, True)
+        if item_hash in self.seen:
+            self.gossip_stats['duplicates_received'] += 1
+            return False
+        self.seen.put(item_hash, True)
+        return True
+
+    def ask_async(self, node, message):
+        '''Sends message to node, returns a Future of the response data'''
+        future = Future()
+        self.responses[message.id] = future
+        future.add_done_callback(lambda f: self.responses.pop(message.id, None))
+        self.send_message(node, message)
+        return future
+
+    def ask(self, node, message, timeout=None):
+        '''Response data of node to message. Raises concurrent.futures.TimeoutError'''
+        future = self.ask_async(node, message)
+        try:
+            return future.result(timeout or self.config.get('ask_timeout', 10))
+        finally:
+            future.cancel()
+
+    def ask_all(self, nodes, code, data={}, timeout=None):
+        '''Asks all nodes at once. Returns {node: response data} of the ones answering in time'''
+        futures = {node: self.ask_async(node, Message(code, data)) for node in nodes}
+        wait(futures.values(), timeout or self.config.get('ask_timeout', 10))
+        responses = {}
+        for node, future in futures.items():
+            if future.cancel(): # not answered
+                continue
+            responses[node] = future.result()
+        return responses
+
+    def request_sync(self):
+        '''
+        sync_chain in the background. Message handlers must not sync
+        themselves: they run on a connection thread, which would then never
+        read the responses of that peer.
+        '''
+        threading.Thread(target=self.sync_chain, daemon=True).start()
     
     def sync_chain(self):
-        # get chain from all connected nodes, checks if there's a better blockchain
-
-        better = None 
+        if not self.sync_lock.acquire(blocking=False):
+            return # already syncing
         try:
-            self_dens = self.bc.length()/minutesPassed(self.bc.getBlock(0).timestamp)
-        except ZeroDivisionError:
-            self_dens = 0
-
-        for node in self.all_nodes:
-            node_chain_data = self.ask(node, Message('CHAIN_INFO?'))
-
-            try:
-                dens = node_chain_data['length']/minutesPassed(node_chain_data['started_in'])
-            except ZeroDivisionError:
-                dens = 0
-
-            if self_dens > dens:
+            self._sync_chain()
+        except concurrent.futures.TimeoutError:
+            logger.error('sync aborted, node did not answer.')
+        except (blockchain.InvalidBlock, blockchain.InvalidBlockTransaction) as e:
+            logger.error('sync aborted. ' + str(e))
+        finally:
+            self.sync_lock.release()
+
+    def _sync_chain(self):
+        # headers first: picks the connected node advertising the most work
+        # (nodes with no more than ours are never downloaded from), gets its
+        # headers from the point where it forks from ours, checks they really
+        # have more work, then downloads only the block bodies.
+        better = None # (work over ours, node, fork height, headers)
+        chain_infos = self.ask_all(self.all_nodes, 'CHAIN_INFO?')
+        our_work = self.bc.work()
+        candidates = [
+            (node, info) for node, info in chain_infos.items() 
+            if info.get('work', our_work + 1) > our_work # nodes not advertising it are tried last
+        ]
+        candidates.sort(key=lambda c: c[1].get('work', -1), reverse=True)
+        for node, node_chain_data in candidates:
+            fork, headers = self.download_headers(node, node_chain_data['length'])
+            if not headers:
                 continue
 
-            if better == None:
-                node_chain_data['node'] = node
-                node_chain_data['dens'] = dens
-                better = node_chain_data
-            elif (dens > better['dens']):
-                node_chain_data['node'] = node
-                node_chain_data['dens'] = dens
-                better = node_chain_data
+            if fork < 0: # another genesis
+                work = blockchain.chain_work(headers) - our_work
+            else: # work of their branch minus work of ours
+                fork_block = self.bc.getHeaders(fork, fork+1)
+                work = blockchain.chain_work(fork_block + headers) - (our_work - self.bc.work(fork))
+
+            if work > 0:
+                better = (work, node, fork, headers)
+                break
+            logger.error(f'{node.id} advertised more work than its headers have.')
 
         if not better:
             logger.info('no better chain found.')
             return # if there's no better, return
         
         # sync with best chain.              
-        logger.success('better blockchain found!')                                           
-        self_last_exists = self.ask(node, Message('HAVE_THIS_BLOCK_HASH?', {'hash':self.bc.lastBlock().hash()}))['exists']   
-        new_chain = False
-        next_height = None
-        if not self_last_exists:
-            logger.success('need to reset chain.')
-            new_chain = True
-            next_height = 0
+        logger.success('better blockchain found!')
+        work, node, fork, headers = better
+        reset = (fork < 0)
+        if reset:
+            logger.success('chain with another genesis, need to reset chain.')
+            # the new chain is swapped in before the old one is closed: threads
+            # still using it (mining, handlers) keep working on the removed file
+            old = self.bc
+            with old.lock:
+                os.remove(self.config['blockchain_file'])
+                self.bc = blockchain.BlockChain(
+                    self.config['blockchain_file'], 
+                    genesisBlock=headers[0], 
+                    onlyHeaders=old.onlyHeaders, 
+                    pragmas=self.config.get('sqlite_pragmas')
+                )
+                self.mempool.bc = self.bc
+            old.close()
+            headers = headers[1:]
+            fork = 0
+
+        branch = [] # blocks replacing ours after the fork
+        if self.bc.onlyHeaders:
+            branch = headers
         else:
-            logger.success('no need to reset chain.')
-            next_height = self.bc.length()
-        
-        while self.bc.length() < better['length']:
-            logger.info(f"Updating chain ({self.bc.length()}/{better['length']})")
-            next_block = blockchain.Block.from_dict(self.ask(node, Message('BLOCK?', {'height': next_height})))
-            if new_chain:
-                os.remove(CONFIG['blockchain_file'])
-                self.bc = blockchain.BlockChain(CONFIG['blockchain_file'], genesisBlock=next_block)
-                new_chain = False
+            # every full node serving the same chain can be downloaded from
+            nodes = [
+                n for n, info in chain_infos.items() 
+                if (info['last'] == chain_infos[node]['last']) and not info.get('only_headers')
+            ]
+            if not nodes:
+                logger.error('no node can serve the blocks of the better chain.')
+                return
+            expected = {fork + 1 + i: h.hash() for i, h in enumerate(headers)}
+            if fork == self.bc.length() - 1: # extends our chain: connected as they arrive
+                self.download_blocks(nodes, fork + 1, fork + 1 + len(headers), expected)
             else:
-                self.bc.insertNewBlock(next_block)
-
-            next_height += 1
-        
+                self.download_blocks(nodes, fork + 1, fork + 1 + len(headers), expected, connect=branch.extend)
+
+        if branch:
+            logger.success(f'reorganization: {self.bc.length() - 1 - fork} blocks out, {len(branch)} in.')
+            disconnected = self.bc.reorganize(fork, branch)
+            for b in branch:
+                self.mempool.block_connected(b)
+            for b in disconnected:
+                self.mempool.block_disconnected(b)
+        if reset or branch:
+            self.mempool.revalidate() # drops the ones spending outputs of the disconnected blocks
+        self.miner.cancel()
         logger.success('chain updated.')
 
-    def node_message(self, connected_node, data):
-        msg = Message.from_dict(data)
+    def find_fork(self, node, length):
+        '''
+        Height of the last block of our chain that node also has (-1 if none,
+        another genesis). Binary search over our heights, asking node with
+        HAVE_THIS_BLOCK_HASH?: O(log n) requests.
+        '''
+        def has(height):
+            block_hash = self.bc.getHeaders(height, height+1)[0].hash()
+            return self.ask(node, Message('HAVE_THIS_BLOCK_HASH?', {'hash': block_hash}))['exists']
+
+        low, high = -1, min(self.bc.length(), length) # node has low, not high
+        if has(high - 1):
+            return high - 1
+        high -= 1
+        while high - low > 1:
+            middle = (low + high)//2
+            if has(middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def download_headers(self, node, length):
+        '''
+        Downloads and validates the headers of the chain of node after the
+        point where it forks from ours. Returns (fork height, headers).
+        Headers are [] if the chain is invalid.
+        '''
+        fork = self.find_fork(node, length)
+        last = self.bc.getHeaders(fork, fork+1)[0] if fork >= 0 else None
+
+        headers = []
+        while fork + 1 + len(headers) < length:
+            page = self.ask(node, Message('HEADERS?', {'start': fork + 1 + len(headers), 'end': length}))['headers']
+            if not page:
+                break
+            headers += [blockchain.Block.from_header(h) for h in page]
+
+        for h in headers:
+            if (last is not None) and not blockchain.BlockChain.valid(last, h):
+                logger.error(f'Invalid header chain from {node.id}.')
+                return fork, []
+            last = h
+        return fork, headers
+
+    def connect_blocks(self, blocks):
+        self.bc.insertNewBlocks(blocks)
+        for b in blocks:
+            self.mempool.block_connected(b)
+
+    def receive_block(self, new_block):
+        '''Connects a block received from a peer and relays it'''
+        try:
+            self.bc.insertNewBlock(new_block)
+            self.miner.cancel()
+            logger.success('New block added to the blockchain: ' + new_block.hash())
+            logger.debug(f'Public key cache: {blockchain.PUBLIC_KEYS.stats()}')
+            logger.debug(f'Gossip: {self.gossip_stats}')
+            self.mempool.block_connected(new_block)
+
+            if not self.bc.onlyHeaders: # can not send what it does not have
+                self.announce('block', new_block.hash())
+        except blockchain.InvalidBlock:
+            logger.error('Invalid block. ' + new_block.hash())
+            if new_block.prevHash != self.bc.lastBlock().hash():
+                logger.error('Block does not match current chain.')
+                self.request_sync()
+        except blockchain.InvalidBlockTransaction:
+            logger.error('Invalid transaction in block. ' + new_block.hash())
+            self.request_sync()
+
+    def complete_compact_block(self, node, header, transactions, missing):
+        '''
+        Asks node for the missing transactions of a compact block, then
+        connects it. If the rebuilt block does not match the header (short
+        id collision), all its transactions are asked for.
+        '''
+        try:
+            for indexes in (missing, range(len(transactions))):
+                if indexes:
+                    received = self.ask(node, Message('BLOCK_TXS?', {'hash': header.hash(), 'indexes': list(indexes)}))['transactions']
+                    if len(received) != len(indexes):
+                        logger.error('Node could not send the transactions of block ' + header.hash())
+                        break
+                    for i, t in zip(indexes, received):
+                        transactions[i] = blockchain.Transaction.from_dict(t)
+
+                new_block = blockchain.Block.from_header(header.header())
+                new_block.addTransactions(transactions)
+                if new_block.hash() == header.hash():
+                    self.receive_block(new_block)
+                    return
+            else:
+                logger.error('Transactions do not match block ' + header.hash())
+        except concurrent.futures.TimeoutError:
+            logger.error('Node did not send the transactions of block ' + header.hash())
+        self.seen.pop(header.hash()) # can be fetched again from another node
+
+    def download_blocks(self, nodes, start, end, expected=None, connect=None):
+        '''
+        Downloads and connects the blocks [start, end). Up to sync_window
+        BLOCKS? requests of sync_batch blocks are kept in flight, spread over
+        nodes. Batches are connected in height order as they arrive, each one
+        in a single database transaction. expected: {height: hash} of the
+        already validated headers the blocks must match. connect(blocks)
+        replaces the connection of the batches (e.g. to collect a branch).
+        '''
+        connect = connect or self.connect_blocks
+        batch = min(self.config.get('sync_batch', 50), MAX_BLOCKS_PER_MESSAGE) # whole batches in each answer
+        window = self.config.get('sync_window', 8)
+        timeout = self.config.get('ask_timeout', 10)
+        pending = {} # first height -> [end height, Future, attempts]
+        next_request = start
+        requests = 0
+
+        def request(first, last, attempts=0):
+            nonlocal requests
+            node = nodes[requests % len(nodes)]
+            requests += 1
+            pending[first] = [last, self.ask_async(node, Message('BLOCKS?', {'start': first, 'end': last})), attempts]
 
+        try:
+            while start < end:
+                while (next_request < end) and (len(pending) < window):
+                    request(next_request, min(next_request + batch, end))
+                    next_request = min(next_request + batch, end)
+
+                last, future, attempts = pending.pop(start)
+                try:
+                    blocks = future.result(timeout)['blocks'][:last - start] # no more than asked for
+                except concurrent.futures.TimeoutError:
+                    future.cancel()
+                    blocks = None
+                if (blocks is None) or (len(blocks) < last - start): # timed out, or short answer
+                    if attempts + 1 >= len(nodes):
+                        raise concurrent.futures.TimeoutError(f'no node sent the blocks [{start}, {last})')
+                    request(start, last, attempts + 1) # from the next node
+                    continue
+
+                blocks = [blockchain.Block.from_dict(b) for b in blocks]
+                if expected:
+                    for height, b in enumerate(blocks, start):
+                        if b.hash() != expected.get(height):
+                            raise blockchain.InvalidBlock(b)
+                connect(blocks)
+                start = last
+                logger.info(f'Updating chain ({start}/{end})')
+        finally:
+            for _, future, _ in pending.values():
+                future.cancel()
+
+    def decode(self, connected_node, data):
+        '''Message of a packet (binary or JSON), None if malformed'''
+        if wire.is_packet(data):
+            try:
+                data = wire.loads(data)
+            except wire.WireError as e:
+                logger.error(f'Malformed packet from {connected_node.id}. {e}')
+                return None
+        if not isinstance(data, dict):
+            return None
+        return Message.from_dict(data)
+
+    def resolve(self, msg):
+        '''Completes the Future waiting for msg, if it is a response. True if it was'''
         if msg.response_to:
-            if msg.response_to in self.responses.keys():
-                self.responses[msg.response_to] = msg.data
-
-        if msg.code == 'NEW_NODE':
+            future = self.responses.get(msg.response_to)
+            if future:
+                try:
+                    future.set_result(msg.data)
+                except InvalidStateError: # timed out meanwhile
+                    pass
+                return True
+        return False
+
+    def handle_message(self, connected_node, msg):
+        if msg.code == 'WIRE_FORMATS':
+            if ('binary' in msg.data['formats']) and (self.config.get('wire_format', 'binary') == 'binary'):
+                connected_node.set_info('wire', 'binary')
+
+        elif msg.code == 'NEW_NODE':
             node = msg.data
             if (node['id'] == self.id):
                 return
@@ -159,117 +462,152 @@ class P2PNode(Node):
                     return
 
             if self.connect_with_node(node['host'], node['port']):
-                self.send_to_nodes(Message('NEW_NODE', {'id': node['id'], 'host':connected_node.host, 'port':int(connected_node.port)}).to_json())
+                self.broadcast(Message('NEW_NODE', {'id': node['id'], 'host':connected_node.host, 'port':int(connected_node.port)}))
 
-        elif msg.code == 'NEW_BLOCK':
+        elif msg.code == 'NEW_BLOCK': # full block, from nodes not sending compact blocks
             new_block = blockchain.Block.from_dict(msg.data)
 
-            if new_block.hash() == self.bc.lastBlock().hash():
+            if (not self.received(connected_node, new_block.hash())) or (new_block.hash() == self.bc.lastBlock().hash()):
                 return
 
             logger.info('New block received: ' + new_block.hash())
+            self.receive_block(new_block)
 
-            try:
-                self.bc.insertNewBlock(new_block)
-                logger.success('New block added to the blockchain: ' + new_block.hash())
+        elif msg.code == 'COMPACT_BLOCK':
+            header = blockchain.Block.from_header(msg.data['header'])
 
-                # remove transactions unvalidated by new block
-                for i in range(len(self.transaction_pool)):
-                    t = self.transaction_pool.pop(0)
-                    if self.valid_transaction(t):
-                        self.transaction_pool.append(t)
+            if (not self.received(connected_node, header.hash())) or (header.hash() == self.bc.lastBlock().hash()):
+                return
 
-                self.send_to_nodes(msg.to_json())
-            except blockchain.InvalidBlock:
-                logger.error('Invalid block. ' + new_block.hash())
-                if new_block.prevHash != self.bc.lastBlock().hash():
-                    logger.error('Block does not match current chain.')
-                    self.sync_chain()
-            except blockchain.InvalidBlockTransaction:
-                logger.error('Invalid transaction in block. ' + new_block.hash())
-                self.sync_chain()
-            
-            self.clean_transaction_pool()
+            logger.info('New compact block received: ' + header.hash())
+            if header.prevHash != self.bc.lastBlock().hash():
+                logger.error('Block does not match current chain.')
+                self.request_sync()
+                return
+
+            if self.bc.onlyHeaders:
+                self.receive_block(header)
+                return
+
+            try:
+                transactions, missing = self.mempool.reconstruct(msg.data)
+            except (KeyError, IndexError, TypeError, ValueError):
+                logger.error('Malformed compact block. ' + header.hash())
+                return
+            logger.info(f'{len(transactions) - len(missing)}/{len(transactions)} transactions of the block found in the pool.')
+            if not missing:
+                new_block = blockchain.Block.from_header(header.header())
+                new_block.addTransactions(transactions)
+                if new_block.hash() == header.hash():
+                    self.receive_block(new_block)
+                    return
+            # transactions are asked for (the missing ones, or all of them if the
+            # rebuilt block does not match): waiting for the answer here would
+            # block the connection thread reading it
+            threading.Thread(
+                target=self.complete_compact_block, 
+                args=(connected_node, header, transactions, missing), 
+                daemon=True
+            ).start()
+
+        elif msg.code == 'BLOCK_TXS?':
+            height = self.bc.get_height(msg.data['hash'])
+            transactions = []
+            if (height is not None) and not self.bc.onlyHeaders:
+                block = self.bc.getBlock(height)
+                transactions = [
+                    block.transactions[i].to_dict() 
+                    for i in msg.data['indexes'] if 0 <= i < len(block.transactions)
+                ]
+            self.send_message(connected_node, msg.response('BLOCK_TXS', {'transactions': transactions}))
 
         elif msg.code == 'NEW_TRANSACTION':
+            if self.bc.onlyHeaders: # no UTXO set to validate it
+                return
+
             new_transaction = blockchain.Transaction.from_dict(msg.data)
 
-            if new_transaction in self.transaction_pool:
+            if not self.received(connected_node, new_transaction.hash()):
                 return
 
             logger.info('New transaction received: ' + new_transaction.hash())
 
-            valid_transaction = True
-            # already spent output
-            for transaction in self.transaction_pool:
-                for i in new_transaction.inputs:
-                    if i in transaction.inputs:
-                        valid_transaction = False 
-            if not self.valid_transaction(new_transaction):
-                valid_transaction = False
-
-            if valid_transaction:
-                self.transaction_pool.append(new_transaction)
+            if self.mempool.add(new_transaction):
+                self.miner.cancel()
                 logger.success('New transaction added to the pool: ' + new_transaction.hash())
-                self.send_to_nodes(msg.to_json())
+                self.announce('tx', new_transaction.hash(), exclude=connected_node)
             else:
                 logger.error('Invalid transaction: ' + new_transaction.hash())
         
+        elif msg.code == 'INV':
+            wanted = []
+            for kind, item_hash in msg.data['items']:
+                self.known(connected_node).put(item_hash, True)
+                if (kind == 'tx') and self.bc.onlyHeaders:
+                    continue
+                requested = self.requested.get(item_hash)
+                if (
+                    (item_hash in self.seen) 
+                    or ((requested is not None) and (time() - requested < self.config.get('ask_timeout', 10)))
+                    or ((kind == 'block') and self.bc.block_exists(item_hash))
+                ):
+                    self.gossip_stats['getdata_suppressed'] += 1
+                    continue
+                self.requested.put(item_hash, time())
+                wanted.append([kind, item_hash])
+            if wanted:
+                self.send_message(connected_node, Message('GETDATA', {'items': wanted}))
+
+        elif msg.code == 'GETDATA': # answered with the usual messages, not responses
+            for kind, item_hash in msg.data['items']:
+                if kind == 'tx':
+                    entry = self.mempool.entries.get(item_hash)
+                    if entry:
+                        self.send_message(connected_node, Message('NEW_TRANSACTION', entry.transaction.to_dict()))
+                elif (kind == 'block') and not self.bc.onlyHeaders:
+                    height = self.bc.get_height(item_hash)
+                    if height is not None:
+                        self.send_message(connected_node, Message('COMPACT_BLOCK', self.bc.getBlock(height).to_compact()))
+
         elif msg.code == 'CHAIN_INFO?':
-            res = msg.response('CHAIN_INFO', {'started_in': self.bc.getBlock(0).timestamp, 'length': self.bc.length(), 'genesis':self.bc.getBlock(0).hash()})
-            self.send_to_node(connected_node, res.to_json())
+            res = msg.response('CHAIN_INFO', {
+                'started_in': self.bc.getBlock(0).timestamp, 
+                'length': self.bc.length(), 
+                'genesis': self.bc.getBlock(0).hash(),
+                'last': self.bc.lastBlock().hash(),
+                'work': self.bc.work(),
+                'only_headers': self.bc.onlyHeaders
+            })
+            self.send_message(connected_node, res)
 
         elif msg.code == 'HAVE_THIS_BLOCK_HASH?':
-            self.send_to_node(connected_node, msg.response('HAVE_THIS_BLOCK_HASH', {'exists': self.bc.block_exists(msg.data['hash'])}).to_json())
+            self.send_message(connected_node, msg.response('HAVE_THIS_BLOCK_HASH', {'exists': self.bc.block_exists(msg.data['hash'])}))
         
         elif msg.code == 'BLOCK?':
-            self.send_to_node(connected_node, msg.response('BLOCK', self.bc.getBlock(msg.data['height']).to_dict()).to_json())
+            self.send_message(connected_node, msg.response('BLOCK', self.bc.getBlock(msg.data['height']).to_dict()))
+
+        elif msg.code == 'BLOCKS?':
+            start = max(msg.data['start'], 0)
+            end = min(msg.data['end'], start + MAX_BLOCKS_PER_MESSAGE)
+            blocks = [] if self.bc.onlyHeaders else [b.to_dict() for b in self.bc.getBlocks(start, end)]
+            self.send_message(connected_node, msg.response('BLOCKS', {'blocks': blocks}))
+
+        elif msg.code == 'HEADERS?':
+            start = max(msg.data['start'], 0)
+            end = min(msg.data['end'], start + MAX_HEADERS_PER_MESSAGE)
+            headers = [b.header() for b in self.bc.getHeaders(start, end)]
+            self.send_message(connected_node, msg.response('HEADERS', {'headers': headers}))
     
-    def valid_transaction(self, transaction: blockchain.Transaction):
-        '''Returns Fee in case of valid'''
-
-        if not transaction.verify():
-            return False
-
-        utxos = self.bc.get_utxos()
-        pending = self.transaction_pool
-        fee = 0
-
-        for i in transaction.inputs:
-            if not i in utxos.keys():
-                return False
-            if utxos[i]['address'] != blockchain.Address.generate_blockchain_address(transaction.signature[0]):
-                return False
-            fee += utxos[i]['amount']
-        
-        for o in transaction.outputs:
-            fee -= o['amount']
-        
-        if fee < 0:
-            return False
-        
-        return (True, fee)
-
     def create_next_block(self):
-        self.clean_transaction_pool()
-        last_block = self.bc.lastBlock()
-        new_block = blockchain.Block(prevHash=last_block.hash())
-        rew = blockchain.reward(node.bc.length()-1)
-        for t in self.transaction_pool:
-            rew += self.valid_transaction(t)[1]
-        if rew > 0:
-            new_block.addTransaction(blockchain.Transaction([], [{'address':CONFIG['mining_address'], 'amount':rew}]))
-        for t in self.transaction_pool:
-            new_block.addTransaction(t)
+        start = perf_counter()
+        new_block = self.mempool.block_template(
+            self.config['mining_address'], 
+            self.config.get('max_block_size', 1000000), 
+            self.config.get('max_block_transactions')
+        )
+        logger.info(f'Block template built in {1000*(perf_counter() - start):.1f} ms ({len(new_block.transactions)} transactions)')
         return new_block
 
-    def clean_transaction_pool(self):
-        valids = []
-        for transaction in self.transaction_pool:
-            if self.valid_transaction(transaction):
-                valids.append(transaction)
-        self.transaction_pool = valids 
-
     def mine(self):
         while True:
             last_block = self.bc.lastBlock()
@@ -280,36 +618,50 @@ class P2PNode(Node):
                 logger.info(f'Waiting for block to be mineable. ({waiting_time} seconds)')
                 sleep(waiting_time)
             
-            block_changed = False
-            new_transactions = False
-            logger.info('Mining...')
-            while (
-                (not blockchain.BlockChain.valid(last_block, new_block)) and
-                (not block_changed) and
-                (not new_transactions)
-                ):
-                new_block.nonce += 1
-                new_block.timestamp = int(time())
-
-                if last_block != self.bc.lastBlock():
-                    last_block = self.bc.lastBlock()
-                    new_block = self.create_next_block()
-                    block_changed = True
-                if len(self.transaction_pool) > len(new_block.transactionsRaw):
-                    last_block = self.bc.lastBlock()
-                    new_block = self.create_next_block()
-                    new_transactions = True
-
-            if block_changed:
-                logger.info('Block changed. Re-starting miner.')                
-            elif new_transactions:
-                logger.info('New transactions. Adding them to new block.')
-            else:
-                logger.success('New block mined.')
+            logger.info(f'Mining... ({self.miner.workers} workers)')
+            if not self.miner.mine(last_block, new_block):
+                logger.info(f'Block or transactions changed. Re-starting miner. ({self.miner.hashrate:.0f} H/s)')
+                continue
+
+            logger.success(f'New block mined. ({self.miner.hashrate:.0f} H/s)')
+            try:
                 self.bc.insertNewBlock(new_block)
-                self.send_to_nodes(Message('NEW_BLOCK', new_block.to_dict()).to_json())
-                sleep(1)
-                self.clean_transaction_pool()
+            except blockchain.InvalidBlock:
+                logger.info('Block changed. Re-starting miner.')
+                continue
+            except blockchain.InvalidBlockTransaction as e:
+                logger.error(f'{e} Dropped from the pool. Re-starting miner.')
+                self.mempool.remove(e.transaction.hash())
+                self.mempool.revalidate() # and any other one gone invalid
+                continue
+            self.mempool.block_connected(new_block)
+            self.seen.put(new_block.hash(), True)
+            self.announce('block', new_block.hash())
+
+class P2PNode(BlockchainNode, Node):
+    '''p2pnetwork node: a thread per connection, running the handlers of its messages'''
+    def __init__(self, host, port, config, id=None, callback=None, max_connections=0):
+        Node.__init__(self, host, port, id, callback, max_connections)
+        BlockchainNode.__init__(self, config)
+
+    def outbound_node_connected(self, connected_node):
+        print("outbound_node_connected: " + connected_node.id)
+        self.node_connected(connected_node, inbound=False)
+
+    def inbound_node_connected(self, connected_node):
+        print("inbound_node_connected: " + connected_node.id)
+        self.node_connected(connected_node, inbound=True)
+
+    def inbound_node_disconnected(self, connected_node):
+        print("inbound_node_disconnected: " + connected_node.id)
+
+    def outbound_node_disconnected(self, connected_node):
+        print("outbound_node_disconnected: " + connected_node.id)
+
+    def node_message(self, connected_node, data):
+        msg = self.decode(connected_node, data)
+        if msg and not self.resolve(msg):
+            self.handle_message(connected_node, msg)
 
     def node_disconnect_with_outbound_node(self, connected_node):
         print("node wants to disconnect with oher outbound node: " + connected_node.id)
@@ -317,10 +669,200 @@ class P2PNode(Node):
     def node_request_to_stop(self):
         print("node is requested to stop!")
 
-node = P2PNode(CONFIG['host'], int(CONFIG['port']))
-node.start()
-for host, port in CONFIG['nodes']:
-    node.connect_with_node(host, int(port))
+EOT = b'\x04' # end of a packet, as in p2pnetwork
+
+def parse_packet(packet):
+    '''dict of a JSON packet, bytes of a binary one, None otherwise (as p2pnetwork does)'''
+    if wire.is_packet(packet):
+        return packet
+    try:
+        return loads(packet.decode())
+    except ValueError: # not UTF-8 / JSON
+        return None
+
+class AsyncPeer:
+    '''Connection of an AsyncP2PNode. Same attributes as a p2pnetwork NodeConnection'''
+    def __init__(self, main_node, reader, writer, id, host, port):
+        self.main_node = main_node
+        self.reader = reader
+        self.writer = writer
+        self.id = id
+        self.host = host
+        self.port = port
+        self.info = {}
+        self.messages = asyncio.Queue() # waiting for their handler, in arrival order
+        self.tasks = []
+
+    def set_info(self, key, value):
+        self.info[key] = value
+
+    def get_info(self, key):
+        return self.info[key]
+
+    def send(self, data):
+        '''Thread safe, does not wait for the data to be written'''
+        if isinstance(data, str):
+            data = data.encode()
+        self.main_node.loop.call_soon_threadsafe(self.write, data + EOT)
+
+    def write(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+class AsyncP2PNode(BlockchainNode):
+    '''
+    Node running all its connections on one asyncio event loop, in a
+    background thread. Speaks the same protocol as P2PNode, and they can be
+    peers. The loop only reads and writes sockets: packets are decoded on
+    the decoder threads, handlers run on the executor threads. Messages of a
+    peer are handled one at a time, in order, but a slow handler does not
+    delay the other peers, nor the responses it is waiting for.
+    '''
+    def __init__(self, host, port, config, id=None):
+        BlockchainNode.__init__(self, config) # forks the miner, before any thread exists
+        self.host = host
+        self.port = port # 0: any free port, set once listening
+        self.id = id or uuid4().hex
+        self.peers = []
+        self.server = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.decoder = ThreadPoolExecutor(2)
+        self.executor = ThreadPoolExecutor(config.get('async_workers', 16))
+
+    @property
+    def all_nodes(self):
+        return list(self.peers)
+
+    def call(self, coroutine):
+        '''Runs coroutine on the loop, from another thread, and waits for its result'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def start(self):
+        self.thread.start()
+        self.call(self.listen())
+
+    def stop(self):
+        self.call(self.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.decoder.shutdown(wait=False, cancel_futures=True)
+        self.miner.stop()
+
+    def join(self):
+        self.thread.join()
+
+    def send_to_node(self, node, data):
+        node.send(data)
+
+    def connect_with_node(self, host, port):
+        if self.loop.is_running() and (threading.current_thread() is self.thread):
+            raise RuntimeError('connect_with_node would block the event loop')
+        return self.call(self.connect(host, int(port)))
+
+    async def listen(self):
+        self.server = await asyncio.start_server(self.accept, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for peer in self.all_nodes:
+            self.disconnect(peer)
+        await self.server.wait_closed()
+
+    async def accept(self, reader, writer):
+        # p2pnetwork handshake: receives "id:port", sends its id
+        host, port = writer.get_extra_info('peername')[:2]
+        handshake = (await reader.read(4096)).decode()
+        if ':' in handshake:
+            handshake, port = handshake.split(':')
+        writer.write(self.id.encode())
+        await writer.drain()
+        self.add_peer(AsyncPeer(self, reader, writer, handshake, host, port), inbound=True)
+
+    async def connect(self, host, port):
+        for peer in self.peers:
+            if (peer.host == host) and (int(peer.port) == port):
+                return True
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f'{self.id}:{self.port}'.encode())
+            await writer.drain()
+            handshake = await reader.read(4096)
+        except OSError as e:
+            logger.error(f'Could not connect with {host}:{port}. {e}')
+            return False
 
-node.sync_chain()
-node.mine()
\ No newline at end of file
+        # the first messages may arrive with the id: ids are hex, messages start with { or the wire magic byte
+        end = min([i for i in (handshake.find(b'{'), handshake.find(wire.MAGIC)) if i >= 0], default=len(handshake))
+        node_id, buffer = handshake[:end].decode(), handshake[end:]
+        if (node_id == self.id) or any(p.id == node_id for p in self.peers):
+            writer.write('CLOSING: Already having a connection together'.encode())
+            writer.close()
+            return True
+        self.add_peer(AsyncPeer(self, reader, writer, node_id, host, port), inbound=False, buffer=buffer)
+        return True
+
+    def add_peer(self, peer, inbound, buffer=b''):
+        logger.info(f'{"inbound" if inbound else "outbound"} node connected: {peer.id}')
+        self.peers.append(peer)
+        peer.tasks = [self.loop.create_task(self.read(peer, buffer)), self.loop.create_task(self.handle(peer))]
+        self.node_connected(peer, inbound)
+
+    def disconnect(self, peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+            logger.info(f'node disconnected: {peer.id}')
+        peer.writer.close()
+        for task in peer.tasks:
+            task.cancel()
+
+    def receive(self, peer, packet):
+        # on a decoder thread
+        msg = self.decode(peer, parse_packet(packet))
+        if msg and self.resolve(msg):
+            return None
+        return msg
+
+    async def read(self, peer, buffer):
+        try:
+            while True:
+                *packets, buffer = buffer.split(EOT)
+                for packet in packets:
+                    if not packet:
+                        continue
+                    msg = await self.loop.run_in_executor(self.decoder, self.receive, peer, packet)
+                    if msg:
+                        peer.messages.put_nowait(msg)
+                chunk = await peer.reader.read(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        self.disconnect(peer)
+
+    async def handle(self, peer):
+        while True:
+            msg = await peer.messages.get()
+            try:
+                await self.loop.run_in_executor(self.executor, self.handle_message, peer, msg)
+            except Exception:
+                logger.exception(f'Error handling {msg.code} from {peer.id}')
+
+if __name__ == '__main__':
+    CONFIG = load_config(argv[1] if len(argv) > 1 else 'nodeconfig.json')
+    if CONFIG.get('runtime', 'threads') == 'asyncio':
+        node = AsyncP2PNode(CONFIG['host'], int(CONFIG['port']), CONFIG)
+    else:
+        node = P2PNode(CONFIG['host'], int(CONFIG['port']), CONFIG)
+    node.start()
+    for host, port in CONFIG['nodes']:
+        node.connect_with_node(host, int(port))
+
+    node.sync_chain()
+    if node.bc.onlyHeaders:
+        node.join() # monitoring only: follows the chain, does not mine
+    else:
+        node.mine()
\ No newline at end of file
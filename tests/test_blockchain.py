@@ -1,8 +1,14 @@
 import unittest
 from blockchain import *
+from blockchain.SQL_setup import MIGRATIONS
+from blockchain.mempool import Mempool
 from time import sleep
 import os
 import shutil
+import threading
+import sqlite3
+import random
+from hashlib import sha256
 
 class TestAddress(unittest.TestCase):
     @classmethod
@@ -21,6 +27,26 @@ class TestAddress(unittest.TestCase):
             )
         )
 
+    def test_public_key_cache(self):
+        pem = self.a.sign('mock')[0]
+        self.assertEqual(PUBLIC_KEYS.address(pem), self.a.address)
+        hits = PUBLIC_KEYS.hits
+        key = PUBLIC_KEYS.public_key(pem)
+        self.assertIs(PUBLIC_KEYS.public_key(pem), key)
+        self.assertEqual(Address.generate_blockchain_address(pem), self.a.address)
+        self.assertEqual(PUBLIC_KEYS.hits, hits+3)
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        c = LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        c.get('a')
+        c.put('c', 3) # evicts b, the least recently used
+        self.assertNotIn('b', c)
+        self.assertEqual(c.get('b', 'missing'), 'missing')
+        self.assertEqual(c.stats(), {'size': 2, 'hits': 1, 'misses': 1})
+
 class TestTransaction(unittest.TestCase):
     @classmethod
     def setUpClass(self) -> None:
@@ -51,6 +77,18 @@ class TestTransaction(unittest.TestCase):
         ]
         self.assertFalse(self.t.verify())
 
+    def test_verify_many(self):
+        signed = Transaction(['000'], [{"amount":10, "address":'a'}])
+        signed.signature = self.a.sign(signed.hash())
+        unsigned = Transaction([], [{"amount":10, "address":'a'}])
+        bad_key = Transaction([], [{"amount":10, "address":'a'}])
+        bad_key.signature = ['not a key', 'ff']
+        self.assertEqual(verify_many([signed, unsigned, bad_key]), [True, False, False])
+
+        hits = VERIFIED.hits
+        self.assertTrue(signed.verify()) # cached
+        self.assertEqual(VERIFIED.hits, hits+1)
+
 class TestMerkle(unittest.TestCase):
     def test_root(self):
         m = Merkle()
@@ -112,6 +150,25 @@ class TestMerkle(unittest.TestCase):
             }
         )
 
+    def test_incremental_and_bulk(self):
+        hashes = [sha256(str(i).encode()).hexdigest() for i in range(37)]
+        bulk = Merkle(hashes)
+        shuffled = list(hashes)
+        random.Random(42).shuffle(shuffled)
+        incremental = Merkle()
+        for n, h in enumerate(shuffled):
+            incremental.add(h)
+            self.assertEqual(incremental.root(), Merkle(shuffled[:n+1]).root())
+        self.assertEqual(incremental.root(), bulk.root())
+
+        for h in hashes:
+            proof = incremental.proof(h)
+            self.assertEqual(proof, bulk.proof(h))
+            for side, sibling in proof['path']:
+                h = sha256((sibling + h if side == 'left' else h + sibling).encode()).hexdigest()
+            self.assertEqual(h, proof['root'])
+        self.assertIsNone(bulk.proof('not in the tree'))
+
 class TestBlock(unittest.TestCase):
     def add_transaction(self):
         a = Address()
@@ -184,3 +241,523 @@ class TesstBlockChain(unittest.TestCase):
         for tampered in [self.tampered_db_name_1, self.tampered_db_name_2]:
             with self.assertRaises(InvalidBlockchain):
                 BlockChain(tampered)
+
+class ChainTestCase(unittest.TestCase):
+    '''Fresh copy of the test chain for every test, plus helpers to extend it.'''
+    @classmethod
+    def setUpClass(self) -> None:
+        if not hasattr(ChainTestCase, 'a'): # key generation is slow, share it
+            ChainTestCase.a = Address()
+
+    def setUp(self) -> None:
+        self.DB_NAME = './tests/test-CHAIN_COPY.db'
+        shutil.copy('./tests/test.db', self.DB_NAME)
+        self.b = BlockChain(self.DB_NAME)
+
+    def tearDown(self) -> None:
+        self.b.close()
+        os.remove(self.DB_NAME)
+
+    def next_block(self, transactions):
+        last = self.b.lastBlock()
+        block = Block(last.hash())
+        block.timestamp = last.timestamp + 600 # difficulty 0
+        for t in transactions:
+            block.addTransaction(t)
+        return block
+
+    def coinbase(self):
+        return Transaction([], [{'address': self.a.address, 'amount': reward(self.b.length()-1)}])
+
+    def spend(self, utxo_hash, receivers):
+        t = Transaction([utxo_hash], [{'address': r, 'amount': 10} for r in receivers])
+        t.signature = self.a.sign(t.hash())
+        return t
+
+class TestUTXOSet(ChainTestCase):
+
+    def test_utxos_follow_blocks(self):
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        utxo_hash = coinbase.outputs_to_tuples()[0][0]
+        self.assertEqual(self.b.get_utxo(utxo_hash)['address'], self.a.address)
+
+        spend = self.spend(utxo_hash, ['b'])
+        self.b.insertNewBlock(self.next_block([self.coinbase(), spend]))
+        self.assertIsNone(self.b.get_utxo(utxo_hash))
+        self.assertIn(spend.outputs_to_tuples()[0][0], self.b.get_utxos())
+
+        self.b.remove_last_block()
+        self.assertEqual(self.b.length(), 3)
+        self.assertEqual(self.b.get_utxo(utxo_hash)['amount'], coinbase.outputs[0]['amount'])
+        self.assertEqual(list(self.b.get_utxos().keys()), [utxo_hash])
+
+    def test_address_utxos(self):
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        utxo_hash = coinbase.outputs_to_tuples()[0][0]
+        self.assertEqual(list(self.b.get_utxos_for(self.a.address)), [utxo_hash])
+        self.assertEqual(self.b.balance(self.a.address), coinbase.outputs[0]['amount'])
+        self.assertEqual(self.b.balance('b'), 0) # cached, empty
+
+        self.b.insertNewBlock(self.next_block([self.coinbase(), self.spend(utxo_hash, ['b', 'c'])]))
+        self.assertEqual(self.b.balance('b'), 10)
+        self.assertNotIn(utxo_hash, self.b.get_utxos_for(self.a.address))
+
+        self.b.remove_last_block()
+        self.assertEqual(self.b.balance('b'), 0)
+        self.assertEqual(list(self.b.get_utxos_for(self.a.address)), [utxo_hash])
+
+    def test_address_utxos_other_writer(self):
+        reader = BlockChain(self.DB_NAME) # e.g. wallet.py, next to a node
+        self.assertEqual(reader.balance(self.a.address), 0)
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        self.assertEqual(reader.balance(self.a.address), coinbase.outputs[0]['amount'])
+        reader.close()
+
+    def test_double_spend_in_block(self):
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        utxo_hash = coinbase.outputs_to_tuples()[0][0]
+
+        spends = [self.spend(utxo_hash, ['b']), self.spend(utxo_hash, ['c'])]
+        with self.assertRaises(InvalidBlockTransaction):
+            self.b.insertNewBlock(self.next_block([self.coinbase()] + spends))
+
+    def test_duplicate_transaction(self):
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        spend = self.spend(coinbase.outputs_to_tuples()[0][0], ['b'])
+        block = self.next_block([self.coinbase(), spend])
+        block.transactions.append(spend)
+        with self.assertRaises(InvalidBlock):
+            self.b.insertNewBlock(block)
+        self.assertEqual(self.b.length(), 3)
+
+    def test_bad_signature(self):
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        spend = self.spend(coinbase.outputs_to_tuples()[0][0], ['b'])
+        spend.signature = [spend.signature[0], 'ff'*512]
+        with self.assertRaises(InvalidBlockTransaction):
+            self.b.insertNewBlock(self.next_block([self.coinbase(), spend]))
+
+    def test_insert_blocks_batch(self):
+        first = self.next_block([self.coinbase()])
+        second = Block(first.hash())
+        second.timestamp = first.timestamp + 600
+        self.b.insertNewBlocks([first, second])
+        self.assertEqual(self.b.length(), 4)
+
+        third = Block(second.hash())
+        third.timestamp = second.timestamp + 600
+        with self.assertRaises(InvalidBlock): # all or none
+            self.b.insertNewBlocks([third, Block('fakehash')])
+        self.assertEqual(self.b.length(), 4)
+
+class TestReorganize(ChainTestCase):
+    def branch(self, parent, transactions_list, offset):
+        blocks = []
+        for transactions in transactions_list:
+            b = Block(parent.hash())
+            b.timestamp = parent.timestamp + 600 + offset # difficulty 0, different hashes per branch
+            b.addTransactions(transactions)
+            blocks.append(b)
+            parent = b
+        return blocks
+
+    def test_reorganize(self):
+        coinbase = self.coinbase()
+        self.b.insertNewBlock(self.next_block([coinbase]))
+        fork = self.b.lastBlock()
+        utxo_hash = coinbase.outputs_to_tuples()[0][0]
+
+        spend = self.spend(utxo_hash, ['b'])
+        ours = self.branch(fork, [[self.coinbase(), spend]], 0)
+        self.b.insertNewBlocks(ours)
+        self.assertIsNone(self.b.get_utxo(utxo_hash))
+        self.assertEqual(self.b.balance('b'), 10)
+
+        theirs = self.branch(fork, [[], [], []], 1)
+        self.b.getHeaders(0, self.b.length()) # cached, then replaced
+        disconnected = self.b.reorganize(2, theirs)
+        self.assertEqual([b.to_json() for b in disconnected], [b.to_json() for b in ours])
+        self.assertEqual(self.b.length(), 6)
+        self.assertEqual(self.b.lastBlock(), theirs[-1])
+        self.assertEqual(self.b.getHeaders(3, 6), theirs)
+        self.assertIsNone(self.b.get_height(ours[0].hash()))
+        self.assertEqual(list(self.b.get_utxos()), [utxo_hash]) # spent output restored from the undo records
+        self.assertEqual(self.b.balance('b'), 0)
+        with self.b.db as database:
+            self.assertEqual(database.cursor.execute('SELECT COUNT(*) FROM Undo').fetchone()[0], 0)
+
+    def test_invalid_branch(self):
+        self.b.insertNewBlock(self.next_block([self.coinbase()]))
+        tip = self.b.lastBlock()
+        theirs = self.branch(self.b.getBlock(1), [[], []], 1)
+        theirs[1].prevHash = 'fakehash'
+        with self.assertRaises(InvalidBlock): # all or none
+            self.b.reorganize(1, theirs)
+        self.assertEqual(self.b.lastBlock(), tip)
+        self.assertEqual(self.b.length(), 3)
+        self.assertEqual(self.b.getBlock(2), tip)
+        self.assertIsNone(self.b.get_height(theirs[0].hash()))
+
+class TestBlockCache(ChainTestCase):
+    def test_tip_without_io(self):
+        block = self.next_block([self.coinbase()])
+        self.b.insertNewBlock(block)
+        statements = []
+        self.b.db.connection.set_trace_callback(statements.append)
+        self.assertEqual(self.b.lastBlock(), block)
+        self.assertEqual(self.b.getBlock(2), block)
+        self.assertEqual(self.b.get_height(block.hash()), 2)
+        self.assertEqual(statements, [])
+
+    def test_uncommitted_tip(self):
+        tip = self.b.lastBlock()
+        block = self.next_block([self.coinbase()])
+        seen = []
+        with self.b.db:
+            self.b.insertNewBlock(block)
+            self.assertEqual(self.b.lastBlock(), block) # in this transaction
+            thread = threading.Thread(target=lambda: seen.append(self.b.lastBlock()))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [tip]) # other threads: the committed chain
+        self.assertEqual(self.b.lastBlock(), block)
+
+    def test_rollback(self):
+        tip = self.b.lastBlock()
+        with self.assertRaises(ValueError):
+            with self.b.db:
+                self.b.insertNewBlock(self.next_block([self.coinbase()]))
+                raise ValueError
+        self.assertEqual(self.b.lastBlock(), tip)
+        self.assertIsNone(self.b.getBlock(2))
+
+    def test_headers_out_of_range(self):
+        genesis, first = self.b.getBlock(0), self.b.getBlock(1)
+        self.assertEqual([h.hash() for h in self.b.getHeaders(-1, 2)], [genesis.hash(), first.hash()])
+        self.assertEqual([h.hash() for h in self.b.getHeaders(0, 1)], [genesis.hash()])
+        self.assertEqual([h.hash() for h in self.b.getHeaders(1, 2)], [first.hash()])
+        self.assertEqual(self.b.getHeaders(2, 1), [])
+        self.assertEqual(self.b.getBlocks(1, 0), [])
+        self.assertEqual([b.hash() for b in self.b.getBlocks(-5, 1)], [genesis.hash()])
+
+class TestSQLDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.DB_NAME = './tests/test-SQL_COPY.db'
+        shutil.copy('./tests/test.db', self.DB_NAME)
+        self.b = BlockChain(self.DB_NAME)
+
+    def tearDown(self) -> None:
+        self.b.close()
+        os.remove(self.DB_NAME)
+
+    def test_scope_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.b.db as database:
+                with self.b.db as inner:
+                    inner.cursor.execute('DELETE FROM Block')
+                self.assertEqual(self.b.length(), None) # visible inside the scope
+                raise ValueError
+        self.assertEqual(self.b.length(), 2)
+
+    def test_failed_commit(self):
+        # a deferred foreign key makes COMMIT fail, leaving the transaction open
+        connection = self.b.db.connection
+        connection.execute('PRAGMA foreign_keys = ON')
+        connection.execute('CREATE TEMP TABLE Parent (id INTEGER PRIMARY KEY)')
+        connection.execute('CREATE TEMP TABLE Child (parent INTEGER REFERENCES Parent (id) DEFERRABLE INITIALLY DEFERRED)')
+        ended = []
+        with self.assertRaises(sqlite3.IntegrityError):
+            with self.b.db as database:
+                database.on_end(ended.append)
+                database.cursor.execute('INSERT INTO Child VALUES (1)')
+        self.assertEqual(ended, [False])
+        with self.b.db as database: # rolled back, new scopes work
+            self.assertEqual(database.cursor.execute('SELECT COUNT(*) FROM Child').fetchone()[0], 0)
+
+    def test_connection_per_thread(self):
+        lengths = []
+        connections = []
+        def read():
+            lengths.append(self.b.length())
+            connections.append(len(self.b.db.connections))
+        for _ in range(10):
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        self.assertEqual(lengths, [2]*10)
+        self.assertEqual(connections, [2]*10)
+        self.assertEqual(len(self.b.db.connections), 1) # closed with their threads
+
+    def test_close_waits_for_scopes(self):
+        inside, closed = threading.Event(), threading.Event()
+        results = []
+        def read():
+            with self.b.db as database:
+                connection = database.connection
+                inside.set()
+                closed.wait()
+                results.append(connection.execute('SELECT COUNT(*) FROM Block').fetchone()[0])
+            results.append(self.b.length()) # reopened
+        thread = threading.Thread(target=read)
+        thread.start()
+        inside.wait()
+        self.b.close()
+        closed.set()
+        thread.join()
+        self.assertEqual(results, [2, 2])
+        self.assertEqual(self.b.length(), 2)
+
+    def test_pragmas(self):
+        self.b.close()
+        self.b = BlockChain(self.DB_NAME, pragmas={'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -1024})
+        connection = self.b.db.connection
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(connection.execute('PRAGMA cache_size').fetchone()[0], -1024)
+        self.assertEqual(self.b.length(), 2)
+
+class TestCheckpoint(ChainTestCase):
+    def checkpoint(self):
+        with self.b.db as database:
+            return database.cursor.execute('SELECT * FROM Checkpoint').fetchall()
+
+    def test_checkpoint_follows_tip(self):
+        self.assertEqual(self.checkpoint(), [(1, self.b.lastBlock().hash())])
+        self.b.insertNewBlock(self.next_block([self.coinbase()]))
+        self.assertEqual(self.checkpoint(), [(2, self.b.lastBlock().hash())])
+        self.b.remove_last_block()
+        self.assertEqual(self.checkpoint(), [(1, self.b.lastBlock().hash())])
+
+    def test_blocks_below_checkpoint_skipped(self):
+        self.b.insertNewBlock(self.next_block([self.coinbase()]))
+        self.b.close()
+
+        con = sqlite3.connect(self.DB_NAME)
+        con.execute('UPDATE Block SET nonce=42 WHERE ROWID=1')
+        con.commit()
+        con.close()
+
+        BlockChain(self.DB_NAME).close() # genesis is below the checkpoint
+        with self.assertRaises(InvalidBlockchain):
+            BlockChain(self.DB_NAME, fullVerify=True)
+
+class TestGetBlocks(ChainTestCase):
+    def test_range(self):
+        coinbase = self.coinbase()
+        first = self.next_block([coinbase])
+        self.b.insertNewBlock(first)
+        second = self.next_block([self.coinbase(), self.spend(coinbase.outputs_to_tuples()[0][0], ['b', 'c'])])
+        self.b.insertNewBlock(second)
+
+        blocks = self.b.getBlocks(0, self.b.length())
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(blocks[2:], [first, second])
+        self.assertEqual(blocks[3].to_json(), second.to_json())
+        self.assertEqual(self.b.getBlock(3).to_json(), second.to_json())
+        self.assertEqual(self.b.getBlocks(1, 3), blocks[1:3])
+        self.assertEqual(self.b.getBlocks(4, 10), [])
+
+class TestHeaders(ChainTestCase):
+    def test_headers_only(self):
+        first = self.next_block([self.coinbase()])
+        second = self.next_block([self.coinbase()])
+        second.prevHash = first.hash()
+        second.timestamp = first.timestamp + 600
+
+        self.b.close()
+        self.b = BlockChain(self.DB_NAME, onlyHeaders=True)
+        utxos = self.b.get_utxos()
+        self.b.insertNewBlocks([Block.from_header(first.header()), Block.from_header(second.header())])
+        self.assertEqual(self.b.lastBlock(), second)
+        self.assertEqual(self.b.get_utxos(), utxos) # no bodies, no UTXOs
+
+        headers = self.b.getHeaders(self.b.length()-2, self.b.length())
+        self.assertEqual(headers, [first, second])
+        self.assertEqual([h.header() for h in headers], [first.header(), second.header()])
+
+    def test_full_chain_needs_bodies(self):
+        block = self.next_block([self.coinbase()])
+        with self.assertRaises(InvalidBlock):
+            self.b.insertNewBlock(Block.from_header(block.header()))
+        self.b.insertNewBlock(block)
+
+    def test_chain_work(self):
+        headers = self.b.getHeaders(0, self.b.length())
+        self.assertEqual(self.b.work(), chain_work(headers))
+        block = self.next_block([self.coinbase()])
+        block.timestamp = headers[-1].timestamp + 60
+        self.assertEqual(chain_work(headers + [block]), self.b.work() + 16**difficulty(headers[-1].timestamp, block.timestamp))
+        self.assertEqual(chain_work(headers[:1]), 0)
+
+    def test_stored_work(self):
+        self.b.insertNewBlock(self.next_block([self.coinbase()]))
+        headers = self.b.getHeaders(0, self.b.length())
+        for height in range(len(headers)):
+            self.assertEqual(self.b.work(height), chain_work(headers[:height+1]))
+        work = self.b.work()
+        self.b.remove_last_block()
+        self.assertEqual(self.b.work(), work - 1) # difficulty 0 block
+
+    def test_backfill_work(self):
+        self.b.insertNewBlock(self.next_block([self.coinbase()]))
+        work = self.b.work()
+        with self.b.db as database:
+            database.cursor.execute('UPDATE Block SET work = NULL')
+        self.b.backfill_work()
+        self.assertEqual(self.b.work(), work)
+
+class TestSchema(ChainTestCase):
+    def query_plan(self, query, params):
+        with self.b.db as database:
+            return ' '.join(
+                row[-1] for row in database.cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+            )
+
+    def test_migrated(self):
+        self.assertEqual(self.b.schema_version(), len(MIGRATIONS))
+        self.b.migrate() # nothing left to apply
+        self.assertEqual(self.b.schema_version(), len(MIGRATIONS))
+
+    def test_hot_queries_use_indexes(self):
+        for query in [
+            'SELECT * FROM UTXO WHERE hash = (?)',
+            'SELECT * FROM UTXO WHERE address = (?)',
+            'SELECT * FROM TInput WHERE utxo_hash = (?)',
+            'SELECT * FROM TInput WHERE tx_hash = (?)',
+            'SELECT * FROM TOutput WHERE tx_hash = (?)',
+            'SELECT * FROM TOutput WHERE address = (?)',
+            'SELECT * FROM TInBlock WHERE block_hash = (?)',
+        ]:
+            self.assertIn('USING', self.query_plan(query, ('hash', )))
+
+        plan = self.query_plan('''SELECT TInput.* FROM Block 
+                             CROSS JOIN TInBlock ON TInBlock.block_hash = Block.hash 
+                             CROSS JOIN TInput ON TInput.tx_hash = TInBlock.transaction_hash 
+                             WHERE Block.ROWID >= (?) AND Block.ROWID <= (?) ORDER BY TInput.ROWID''', (1, 2))
+        self.assertIn('INDEX TInBlock_block_hash', plan)
+        self.assertIn('INDEX TInput_tx_hash', plan)
+
+class TestHashCache(unittest.TestCase):
+    def test_transaction(self):
+        t = Transaction(['000'], [{'amount': 10, 'address': 'a'}])
+        h = t.hash()
+        self.assertNotIn('_hash', t.to_dict())
+        t.timestamp += 1
+        self.assertNotEqual(t.hash(), h)
+        h = t.hash()
+        t.load_inputs_from_tuples([(h, '001')])
+        self.assertNotEqual(t.hash(), h)
+        self.assertEqual(t.hash(), Transaction.from_json(t.to_json()).hash())
+
+    def test_block(self):
+        b = Block.from_tuple((None, 1710764231, 907567, None))
+        self.assertEqual(b.hash(), 'd416380da97a4aaa7dbba8749e4caf2f054c96a50d7c69c3f4ed5b2c3d99fb75')
+        b.nonce += 1
+        self.assertNotEqual(b.hash(), 'd416380da97a4aaa7dbba8749e4caf2f054c96a50d7c69c3f4ed5b2c3d99fb75')
+        h = b.hash()
+        b.addTransaction(Transaction([], [{'amount': 10, 'address': 'a'}]))
+        self.assertNotEqual(b.hash(), h)
+
+class TestMempool(ChainTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.utxos = []
+        for _ in range(2):
+            coinbase = self.coinbase()
+            self.b.insertNewBlock(self.next_block([coinbase]))
+            self.utxos.append(coinbase.outputs_to_tuples()[0][0])
+        self.mempool = Mempool(self.b)
+
+    def spend_with_fee(self, utxo_hash, fee):
+        amount = self.b.get_utxo(utxo_hash)['amount']
+        t = Transaction([utxo_hash], [{'address': 'b', 'amount': amount - fee}])
+        t.signature = self.a.sign(t.hash())
+        return t
+
+    def test_add(self):
+        t = self.spend_with_fee(self.utxos[0], 100)
+        self.assertTrue(self.mempool.add(t))
+        self.assertIn(t.hash(), self.mempool)
+        self.assertEqual(self.mempool.entries[t.hash()].fee, 100)
+        self.assertFalse(self.mempool.add(Transaction.from_json(t.to_json()))) # duplicate
+        self.assertFalse(self.mempool.add(self.spend_with_fee(self.utxos[0], 200))) # double spend
+        self.assertFalse(self.mempool.add(self.spend('unknown', ['b']))) # unexistent output
+        forged = self.spend_with_fee(self.utxos[1], 10).to_dict()
+        forged['outputs'][0]['amount'] += 10
+        forged = Transaction.from_dict(forged)
+        self.assertFalse(self.mempool.add(forged)) # signature does not match
+        self.assertEqual(len(self.mempool), 1)
+
+    def test_add_while_connecting(self):
+        t = self.spend_with_fee(self.utxos[0], 10)
+        block = self.next_block([self.coinbase(), self.spend_with_fee(self.utxos[0], 20)])
+        added = []
+        with self.b.lock: # a block spending the same output is being connected
+            thread = threading.Thread(target=lambda: added.append(self.mempool.add(t)))
+            thread.start()
+            sleep(0.1)
+            self.b.insertNewBlock(block)
+            self.mempool.block_connected(block)
+        thread.join()
+        self.assertEqual(added, [False])
+        self.assertEqual(len(self.mempool), 0)
+
+    def test_fee_rate_order_and_eviction(self):
+        self.mempool.max_transactions = 1
+        low, high = self.spend_with_fee(self.utxos[0], 10), self.spend_with_fee(self.utxos[1], 1000)
+        self.assertTrue(self.mempool.add(low))
+        self.assertTrue(self.mempool.add(high)) # evicts low
+        self.assertEqual([e.hash for e in self.mempool.select(1000000)], [high.hash()])
+        self.assertFalse(self.mempool.add(low))
+
+        self.mempool.max_transactions = 2
+        self.assertTrue(self.mempool.add(low))
+        self.assertEqual([e.hash for e in self.mempool.select(1000000)], [high.hash(), low.hash()])
+
+    def test_block_connected(self):
+        included, conflicting = self.spend_with_fee(self.utxos[0], 10), self.spend_with_fee(self.utxos[1], 10)
+        self.mempool.add(included)
+        self.mempool.add(conflicting)
+        block = self.next_block([self.coinbase(), included, self.spend_with_fee(self.utxos[1], 20)])
+        self.b.insertNewBlock(block)
+        self.mempool.block_connected(block)
+        self.assertEqual(len(self.mempool), 0)
+        self.assertEqual(self.mempool.spends, {})
+
+    def test_compact_block(self):
+        known, unknown = self.spend_with_fee(self.utxos[0], 10), self.spend_with_fee(self.utxos[1], 20)
+        self.mempool.add(known)
+        block = self.next_block([self.coinbase(), known, unknown])
+        compact = Block.from_json(block.to_json()).to_compact()
+        self.assertEqual(len(compact['prefilled']), 1) # coinbase
+
+        transactions, missing = self.mempool.reconstruct(compact)
+        self.assertEqual(missing, [2])
+        transactions[2] = unknown
+        rebuilt = Block.from_header(compact['header'])
+        rebuilt.addTransactions(transactions)
+        self.assertEqual(rebuilt.hash(), block.hash())
+        self.b.insertNewBlock(rebuilt)
+
+        self.mempool.block_connected(rebuilt)
+        self.assertEqual(self.mempool.short_ids, {})
+
+    def test_block_template(self):
+        low, high = self.spend_with_fee(self.utxos[0], 10), self.spend_with_fee(self.utxos[1], 1000)
+        self.mempool.add(low)
+        self.mempool.add(high)
+
+        block = self.mempool.block_template(self.a.address, 1000000, max_transactions=1)
+        self.assertEqual([t.hash() for t in block.transactions[1:]], [high.hash()])
+        self.assertEqual(block.transactions[0].outputs[0]['amount'], reward(self.b.length()-1) + 1000)
+        block.timestamp = self.b.lastBlock().timestamp + 600
+        self.b.insertNewBlock(block)
+
+        smallest = min(e.size for e in self.mempool.entries.values())
+        self.assertEqual(self.mempool.select(smallest - 1), [])
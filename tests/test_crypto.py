@@ -28,4 +28,10 @@ class SignAndVerify(unittest.TestCase):
         
         self.assertFalse(
             crypto.verify(signature, "mensaje de prueba TAMPERED".encode(), self.pub)
-        )
\ No newline at end of file
+        )
+    def test_verify_many(self):
+        messages = [str(i).encode() for i in range(4)]
+        jobs = [(crypto.sign(m, self.priv), m, self.pub) for m in messages]
+        jobs.append((jobs[0][0], messages[1], self.pub)) # wrong message
+        jobs.append(('not hex', messages[0], self.pub))
+        self.assertEqual(crypto.verify_many(jobs), [True]*4 + [False, False])
@@ -0,0 +1,43 @@
+import unittest
+from blockchain import Block, BlockChain
+from blockchain.mining import Miner, HeaderHasher
+from threading import Timer
+from time import time
+
+class TestMiner(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.miner = Miner(workers=2)
+
+    @classmethod
+    def tearDownClass(self):
+        self.miner.stop()
+
+    def test_mine(self):
+        last = Block()
+        last.timestamp = int(time()) - 280 # difficulty 2
+        new = Block(last.hash())
+
+        self.assertTrue(self.miner.mine(last, new))
+        self.assertTrue(BlockChain.valid(last, new))
+        self.assertGreater(self.miner.hashrate, 0)
+
+    def test_cancel(self):
+        last = Block()
+        last.timestamp = int(time()) - 40 # difficulty 50, never found
+        new = Block(last.hash())
+
+        Timer(0.5, self.miner.cancel).start()
+        self.assertFalse(self.miner.mine(last, new))
+        self.assertFalse(self.miner.cancelled.is_set())
+
+class TestHeaderHasher(unittest.TestCase):
+    def test_same_as_block_hash(self):
+        for root, prev in [(None, None), ('a'*64, 'b'*64)]:
+            hasher = HeaderHasher(root, prev)
+            b = Block(prev)
+            b.transactionsRoot = root
+            for timestamp in [1710764231, 1710764232]:
+                for nonce in [0, 1, 907567, 2**40]:
+                    b.timestamp, b.nonce = timestamp, nonce
+                    self.assertEqual(hasher.hash(timestamp, nonce), b.hash())
@@ -0,0 +1,162 @@
+import unittest
+from blockchain import Address, Block, Transaction, reward
+from node import AsyncP2PNode, P2PNode, Message
+from time import sleep, time
+import shutil
+import concurrent.futures
+import threading
+import os
+
+def wait_until(condition, timeout=10):
+    start = time()
+    while not condition():
+        if time() - start > timeout:
+            raise AssertionError('timed out')
+        sleep(0.02)
+
+class TestAsyncNode(unittest.TestCase):
+    '''Loopback peers, each one on its own copy of the test chain'''
+    def make_node(self, node_class, name, **config):
+        db = f'./tests/test-NODE_{name}.db'
+        shutil.copy('./tests/test.db', db)
+        self.files.append(db)
+        config = {'blockchain_file': db, 'mining_address': 'a', 'mining_workers': 1, 'ask_timeout': 5, **config}
+        node = node_class('127.0.0.1', 0, config)
+        node.start()
+        self.nodes.append(node)
+        return node
+
+    def setUp(self):
+        self.files = []
+        self.nodes = []
+        self.a = self.make_node(AsyncP2PNode, 'A')
+        self.b = self.make_node(AsyncP2PNode, 'B')
+        self.assertTrue(self.b.connect_with_node('127.0.0.1', self.a.port))
+        wait_until(lambda: self.a.all_nodes and self.b.all_nodes)
+        wait_until(lambda: self.b.all_nodes[0].info.get('wire') == 'binary')
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.stop()
+            if isinstance(node, P2PNode):
+                node.join()
+            node.bc.close()
+        for f in self.files:
+            os.remove(f)
+
+    def add_blocks(self, node, n, offset=0):
+        for _ in range(n):
+            last = node.bc.lastBlock()
+            block = Block(last.hash())
+            block.timestamp = last.timestamp + 600 + offset # difficulty 0
+            block.addTransaction(Transaction([], [{'address': 'a', 'amount': reward(node.bc.length()-1)}]))
+            node.bc.insertNewBlock(block)
+        return block
+
+    def test_ask(self):
+        peer = self.b.all_nodes[0]
+        info = self.b.ask(peer, Message('CHAIN_INFO?'))
+        self.assertEqual(info['length'], self.a.bc.length())
+        self.assertEqual(info['last'], self.a.bc.lastBlock().hash())
+        self.assertEqual(info['work'], self.a.bc.work())
+
+        blocks = self.b.ask(peer, Message('BLOCKS?', {'start': 0, 'end': 2}))['blocks']
+        self.assertEqual([Block.from_dict(b) for b in blocks], self.a.bc.getBlocks(0, 2))
+
+    def test_block_relay(self):
+        block = self.add_blocks(self.a, 1)
+        self.a.seen.put(block.hash(), True)
+        self.a.announce('block', block.hash())
+        wait_until(lambda: self.b.bc.lastBlock() == block)
+        self.assertEqual(self.b.gossip_stats['duplicates_received'], 0)
+
+    def test_compact_block_mismatch(self):
+        block = self.add_blocks(self.a, 1)
+        wrong = Transaction([], [{'address': 'b', 'amount': 1}])
+        self.b.mempool.reconstruct = lambda compact: ([wrong], []) # e.g. short id collision
+        asked_from = []
+        ask = self.b.ask
+        def ask_recording(node, message, timeout=None):
+            asked_from.append(threading.current_thread())
+            return ask(node, message, timeout)
+        self.b.ask = ask_recording
+
+        self.b.handle_message(self.b.all_nodes[0], Message('COMPACT_BLOCK', block.to_compact()))
+        wait_until(lambda: self.b.bc.lastBlock() == block)
+        self.assertEqual(len(asked_from), 1)
+        self.assertIsNot(asked_from[0], threading.current_thread()) # not on the connection thread
+
+    def test_sync(self):
+        last = self.add_blocks(self.a, 3)
+        self.b.sync_chain()
+        self.assertEqual(self.b.bc.length(), self.a.bc.length())
+        self.assertEqual(self.b.bc.lastBlock(), last)
+
+    def test_less_work_downloads_nothing(self):
+        last = self.add_blocks(self.a, 2)
+        self.add_blocks(self.b, 3, offset=1)
+        self.b.download_headers = lambda *args: self.fail('headers downloaded from a node with less work')
+        self.b.sync_chain()
+        self.assertNotEqual(self.b.bc.lastBlock(), last)
+
+    def test_download_range(self):
+        last = self.add_blocks(self.a, 4)
+        peer = self.b.all_nodes[0]
+        start, end = self.b.bc.length(), self.a.bc.length()
+        ask_async = self.b.ask_async
+        def ask_shifted(shift):
+            def ask(node, message): # answers BLOCKS? with more or fewer blocks than requested
+                if message.code == 'BLOCKS?':
+                    message.data['end'] += shift
+                return ask_async(node, message)
+            return ask
+        self.b.config['sync_batch'] = 2
+
+        self.b.ask_async = ask_shifted(-1)
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            self.b.download_blocks([peer], start, end)
+        self.assertEqual(self.b.bc.length(), start)
+
+        self.b.ask_async = ask_shifted(1)
+        self.b.download_blocks([peer], start, end)
+        self.assertEqual(self.b.bc.lastBlock(), last)
+
+    def test_fork(self):
+        base = self.b.bc.length()
+        self.add_blocks(self.b, 1, offset=1)
+        last = self.add_blocks(self.a, 2)
+        self.b.sync_chain()
+        self.assertEqual(self.b.bc.lastBlock(), last)
+        self.assertEqual(self.a.find_fork(self.a.all_nodes[0], self.b.bc.length()), base + 1)
+
+    def test_reorganization_purges_pool(self):
+        key = Address()
+        last = self.b.bc.lastBlock()
+        block = Block(last.hash())
+        block.timestamp = last.timestamp + 601 # difficulty 0, not the block of a
+        coinbase = Transaction([], [{'address': key.address, 'amount': reward(self.b.bc.length()-1)}])
+        block.addTransaction(coinbase)
+        self.b.bc.insertNewBlock(block)
+        t = Transaction([coinbase.outputs_to_tuples()[0][0]], [{'address': 'b', 'amount': 10}])
+        t.signature = key.sign(t.hash())
+        self.assertTrue(self.b.mempool.add(t))
+
+        self.add_blocks(self.a, 2)
+        self.b.sync_chain()
+        self.assertNotEqual(self.b.bc.lastBlock(), block)
+        self.assertNotIn(t.hash(), self.b.mempool) # its input was created by the disconnected block
+        template = self.b.mempool.block_template('a', 1000000)
+        template.timestamp = self.b.bc.lastBlock().timestamp + 600
+        self.b.bc.insertNewBlock(template)
+
+    def test_threaded_peer(self):
+        c = self.make_node(P2PNode, 'C', wire_format='json')
+        c.sock.settimeout(0.1) # stops without waiting for the 10 s accept timeout
+        self.assertTrue(self.b.connect_with_node('127.0.0.1', c.sock.getsockname()[1]))
+        wait_until(lambda: len(self.b.all_nodes) == 2 and c.all_nodes)
+
+        peer = [n for n in self.b.all_nodes if n.id == c.id][0]
+        self.assertEqual(self.b.ask(peer, Message('CHAIN_INFO?'))['length'], c.bc.length())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from blockchain import Address, Block, Transaction, reward
+from blockchain import wire
+from json import dumps, loads
+from uuid import uuid4
+from time import time
+
+class TestWire(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.a = Address()
+
+        self.block = Block('ab'*32)
+        self.block.timestamp = int(time())
+        self.block.nonce = 123456
+        self.block.addTransaction(Transaction([], [{'address': self.a.address, 'amount': reward(10)}]))
+        t = Transaction(['cd'*32, 'ef'*32], [{'address': 'b', 'amount': 10}, {'address': self.a.address, 'amount': 0}])
+        t.signature = self.a.sign(t.hash())
+        self.block.addTransaction(t)
+
+    def roundtrip(self, value):
+        return wire.loads(wire.dumps(value))
+
+    def test_values(self):
+        for value in [
+            None, True, False, 0, 1, 127, 128, 2**70, -1, -300, 0.5, time(), float('inf'),
+            '', 'a', 'ñandú', 'ab', 'AB', 'abc', 'a'*64, 'AB'*32, str(uuid4()), str(uuid4()).upper(),
+            '-----BEGIN PUBLIC KEY-----', '\x04\x02\x1b\xff',
+            [], [1, [2, [3]]], {}, {'timestamp': 1, 'unknown key': [None, 'x']},
+        ]:
+            decoded = self.roundtrip(value)
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded), type(value))
+
+    def test_block(self):
+        message = {'code': 'NEW_BLOCK', 'data': self.block.to_dict(), 'id': str(uuid4()), 'response_to': None}
+        decoded = self.roundtrip(message)
+        self.assertEqual(decoded, loads(dumps(message))) # same as through JSON
+
+        block = Block.from_dict(decoded['data'])
+        self.assertEqual(block.hash(), self.block.hash())
+        self.assertEqual(block.to_json(), self.block.to_json())
+        self.assertTrue(block.transactions[1].verify())
+
+    def test_smaller_than_json(self):
+        packet = wire.dumps(self.block.to_dict())
+        self.assertLess(len(packet), 0.6*len(self.block.to_json()))
+
+    def test_framing(self):
+        packet = wire.dumps({'data': [4, 2, 27, 255, '\x04\x02'], 'hash': '04'*32})
+        self.assertTrue(packet.startswith(wire.MAGIC))
+        self.assertNotIn(b'\x04', packet)
+        self.assertNotIn(b'\x02', packet)
+        self.assertFalse(wire.is_packet(dumps({}).encode()))
+
+    def test_malformed(self):
+        for packet in [b'{}', wire.MAGIC, wire.MAGIC + b'\x20', wire.MAGIC + b'\x0a\x05', wire.dumps([1])[:-1], wire.dumps(1) + b'\x00']:
+            with self.assertRaises(wire.WireError):
+                wire.loads(packet)
+
+if __name__ == '__main__':
+    unittest.main()
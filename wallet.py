@@ -69,10 +69,9 @@ class App:
         self.balance = 0
         self.utxos = []
 
-        for hash, data in self.blockchain.get_utxos().items():
-            if data['address'] == self.wallet.address:
-                self.balance += data['amount']
-                self.utxos.append({'hash':hash, 'amount':data['amount']})
+        for hash, data in self.blockchain.get_utxos_for(self.wallet.address).items():
+            self.balance += data['amount']
+            self.utxos.append({'hash':hash, 'amount':data['amount']})
         print(f'BALANCE: {self.balance/1000000}')
 
     def select(self):